@@ -1,12 +1,43 @@
+import argparse
+import atexit
+import csv
 import datetime
+import hashlib
+import itertools
+import json
 import logging
 import math
 import multiprocessing
+import os
+import queue
 import re
+import sqlite3
+import tempfile
 import textwrap
-from collections import namedtuple
-from concurrent.futures import ALL_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
-from functools import reduce
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ALL_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from functools import lru_cache, partial, reduce
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 PI = math.pi
 RAD = 0.18
@@ -20,39 +51,476 @@ Z1 = PI * W1 ** 2 / LAMBDA
 Z12 = Z1 ** 2
 EXPR = 2 * PI * DR
 INCR = 8001
-EXPR1 = [
-    2 * ((i - INCR // 2) / 25) * DZ / (Z12 + ((i - INCR // 2) / 25) ** 2)
-    for i in range(INCR)
-]
+
+SATURATION_INTENSITIES = range(10000, 25001, 1000)
+CHUNKS_PER_WORKER = 4
+BLOCK_POINTS = 1024
+WRITE_QUEUE_SIZE = 2
+WRITE_BUFFER_SIZE = 1 << 20
+MEMO_SIZE = 100000
+ADAPTIVE_TOLERANCE = 1e-8
+TRANSFER_TOLERANCE = 1e-8
+TRANSFER_STEP = 2.0
+INVERSE_TOLERANCE = 1e-6
+INVERSE_BRACKET_EXPANSIONS = 30
+FIT_TOLERANCE = 1e-8
+FIT_ITERATIONS = 100
+FIT_STEP = 1e-6
+RADIAL_QUADRATURE = 'rectangle'
+LOW_INTENSITY_TOLERANCE = 1e-4
+QUADRATURE_NODES = {'rectangle': int(0.5 / DR), 'simpson': 151, 'laguerre': 24, 'legendre': 16}
+TABLE_CACHE = os.environ.get('SATIN_TABLE_CACHE')
 
 LASER_FILE = 'laser.dat'
 PIN_FILE = 'pin.dat'
 
 Laser = namedtuple('Laser', 'output_file small_signal_gain discharge_pressure carbon_dioxide')
 Gaussian = namedtuple('Gaussian', 'input_power output_power saturation_intensity')
+Inversion = namedtuple('Inversion', 'saturation_intensity output_power evaluations')
+Fit = namedtuple('Fit', 'small_signal_gain saturation_intensity residuals evaluations')
+Engine = namedtuple('Engine', 'calculate_output_power calculate_output_powers')
+
+
+class SatinConfig(namedtuple('SatinConfig', 'rad w1 dr dz wavelength incr saturation_intensities')):
+    """Model parameters: the beam radius, mirror beam waist, ring width, axial step and wavelength in cm, the
+    number of axial steps and the saturation intensities to calculate.
+
+    Constants derived from them are properties, and tables derived from them are cached per configuration.
+    """
+
+    __slots__ = ()
+
+    @property
+    def rad2(self):
+        return self.rad ** 2
+
+    @property
+    def area(self):
+        return PI * self.rad2
+
+    @property
+    def z12(self):
+        return (PI * self.w1 ** 2 / self.wavelength) ** 2
+
+    @property
+    def expr(self):
+        return 2 * PI * self.dr
+
+    @property
+    def rings(self):
+        return int(0.5 / self.dr)
+
+    @property
+    def radial(self):
+        """DEFAULT_CONFIG with the parameters the radial tables depend on taken from this configuration, so
+        that configurations sharing them share the tables."""
+        return DEFAULT_CONFIG._replace(rad=self.rad, dr=self.dr)
+
+    @property
+    def axial(self):
+        """DEFAULT_CONFIG with the parameters the axial tables depend on taken from this configuration."""
+        return DEFAULT_CONFIG._replace(w1=self.w1, dz=self.dz, wavelength=self.wavelength, incr=self.incr)
+
+    @classmethod
+    def load(cls, path, base=None):
+        """Read a configuration from a JSON object of field values, taking the fields it leaves out from base,
+        which defaults to DEFAULT_CONFIG."""
+        with open(path, encoding='utf-8') as config_file:
+            values = json.load(config_file)
+        unknown = sorted(set(values) - set(cls._fields))
+        if unknown:
+            raise ValueError(f'Unknown model parameters {", ".join(unknown)} in {path}')
+        if 'saturation_intensities' in values:
+            values['saturation_intensities'] = tuple(values['saturation_intensities'])
+        return (base or DEFAULT_CONFIG)._replace(**values)
+
+
+DEFAULT_CONFIG = SatinConfig(RAD, W1, DR, DZ, LAMBDA, INCR, SATURATION_INTENSITIES)
+
+
+class _SharedExecutor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._tables = None
+        self.max_workers = multiprocessing.cpu_count()
+        self.context = None
+
+    def get(self):
+        with self._lock:
+            if self._executor is None:
+                if np is not None:
+                    self._tables = _SharedTables({
+                        _table_key('expr1', DEFAULT_CONFIG): _axial_coefficients(DEFAULT_CONFIG),
+                        _table_key('log_beam_expansion', DEFAULT_CONFIG): _log_beam_expansion(DEFAULT_CONFIG)})
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context(self.context),
+                    initializer=_initialise_worker,
+                    initargs=(self._tables.descriptors if self._tables else [], _engine_settings))
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self._tables is not None:
+                self._tables.close()
+                self._tables = None
+
+
+class _SharedTables:
+    """Tables published in shared memory for the pool's workers to attach to without copying them."""
+
+    def __init__(self, tables):
+        self._memory = []
+        self.descriptors = []
+        for name, table in tables.items():
+            memory = shared_memory.SharedMemory(create=True, size=max(1, table.nbytes))
+            np.ndarray(table.shape, table.dtype, memory.buf)[...] = table
+            self._memory.append(memory)
+            self.descriptors.append((name, memory.name, table.shape, table.dtype.str))
+
+    def close(self):
+        for memory in self._memory:
+            memory.close()
+            memory.unlink()
+        self._memory = []
+
+
+_attached_tables = {}
+_attached_memory = []
+
+
+def _initialise_worker(descriptors, engine_settings):
+    # pool worker initializer: register the engines with the parent's settings, which spawned workers would not
+    # inherit, and attach to its tables
+    _register_default_engines(*engine_settings)
+    _attach_tables(descriptors)
+
+
+def _attach_tables(descriptors):
+    # map the parent's tables in place of any built or inherited ones
+    for name, memory_name, shape, dtype in descriptors:
+        memory = shared_memory.SharedMemory(name=memory_name)
+        table = np.ndarray(shape, dtype, memory.buf)
+        table.flags.writeable = False
+        _attached_tables[name] = table
+        _attached_memory.append(memory)
+    _axial_coefficients.cache_clear()
+    _log_beam_expansion.cache_clear()
+    atexit.register(_detach_tables)
+
+
+def _detach_tables():
+    # the arrays must be released before their memory can be closed; the parent unlinks it
+    _attached_tables.clear()
+    _axial_coefficients.cache_clear()
+    _log_beam_expansion.cache_clear()
+    for memory in _attached_memory:
+        memory.close()
+    _attached_memory.clear()
+
+
+_shared_executor = _SharedExecutor()
+atexit.register(_shared_executor.shutdown)
+
+
+def get_executor():
+    """Return the process pool shared by all calculations, starting it on first use."""
+    return _shared_executor.get()
+
+
+@contextmanager
+def process_pool(max_workers=None, context=None):
+    """Run the enclosed calculations on one shared process pool and shut it down on exit.
+
+    max_workers defaults to the number of CPUs, and context, the multiprocessing start method of the
+    workers, to that of the platform.
+    """
+    _shared_executor.shutdown()
+    _shared_executor.max_workers = max_workers or multiprocessing.cpu_count()
+    _shared_executor.context = context
+    try:
+        yield get_executor()
+    finally:
+        _shared_executor.shutdown()
+        _shared_executor.context = None
+
+
+class _Memo:
+    """Bounded LRU of calculated output powers.
+
+    Concurrent requests for a key that is still being calculated share the in-flight future, so each
+    point is calculated once per process.
+    """
+
+    def __init__(self, max_entries=MEMO_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._in_flight = {}
+
+    def get_or_submit(self, key, submit):
+        """Return a future for key, calling submit() to start the calculation only if no result or request exists."""
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(self._results[key])
+                return future
+            if key in self._in_flight:
+                self.hits += 1
+                return self._in_flight[key]
+            self.misses += 1
+            future = self._in_flight[key] = submit()
+        future.add_done_callback(lambda done: self._store(key, done))
+        return future
+
+    def _store(self, key, future):
+        with self._lock:
+            del self._in_flight[key]
+            if not future.cancelled() and future.exception() is None:
+                self._results[key] = future.result()
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_memo = _Memo()
+
+
+def model_hash(config=None):
+    """Return a short hash of the model parameters, used to tell apart results calculated with other parameters."""
+    config = config or DEFAULT_CONFIG
+    return hashlib.sha256(repr((config.rad, config.w1, config.dr, config.dz, config.wavelength, config.incr)).encode()
+                          ).hexdigest()[:16]
+
+
+class ResultCache:
+    """On-disk SQLite cache of calculated output powers.
+
+    Results are keyed on the engine, the model constants and the input power, small-signal gain and
+    saturation intensity. Once the cache holds more than max_entries results the least recently used
+    ones are evicted. hits and misses count the lookups served and not served from the cache.
+    """
+
+    def __init__(self, path, max_entries=1000000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'engine TEXT, model TEXT, input_power REAL, small_signal_gain REAL, saturation_intensity REAL, '
+            'output_power REAL, last_used REAL, '
+            'PRIMARY KEY (engine, model, input_power, small_signal_gain, saturation_intensity))')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def get_many(self, engine, units, config=None):
+        """Return the cached output power of each (input_power, small_signal_gain, saturation_intensity), or None."""
+        model = model_hash(config)
+        with self._lock, self._connection:
+            output_powers = [
+                self._connection.execute(
+                    'SELECT output_power FROM results WHERE engine = ? AND model = ? AND input_power = ? '
+                    'AND small_signal_gain = ? AND saturation_intensity = ?', (engine, model, *unit)).fetchone()
+                for unit in units]
+            self._connection.executemany(
+                'UPDATE results SET last_used = ? WHERE engine = ? AND model = ? AND input_power = ? '
+                'AND small_signal_gain = ? AND saturation_intensity = ?',
+                [(time.time(), engine, model, *unit) for unit, output_power in zip(units, output_powers)
+                 if output_power is not None])
+        output_powers = [output_power[0] if output_power else None for output_power in output_powers]
+        self.hits += sum(output_power is not None for output_power in output_powers)
+        self.misses += sum(output_power is None for output_power in output_powers)
+        return output_powers
+
+    def put_many(self, engine, units, output_powers, config=None):
+        """Store the output power of each (input_power, small_signal_gain, saturation_intensity)."""
+        model = model_hash(config)
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(engine, model, *unit, output_power, time.time()) for unit, output_power in zip(units, output_powers)])
+            self._connection.execute(
+                'DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used LIMIT '
+                'MAX(0, (SELECT COUNT(*) FROM results) - ?))', (self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
 
 
 class Satin:
     @staticmethod
-    def main():
+    def main(argv=None):
+        args = _parse_args(argv)
+        if args.tolerance != ADAPTIVE_TOLERANCE or args.quadrature != RADIAL_QUADRATURE or args.ring_tolerance:
+            _register_default_engines(args.tolerance, args.quadrature, args.ring_tolerance)
+        config = _get_config(args)
         logging.basicConfig(level=logging.INFO, format='%(message)s')
         start = datetime.datetime.now().timestamp()
 
-        with open(LASER_FILE, encoding='utf-8') as laser_file:
-            input_powers = _get_input_powers()
-            laser_data = laser_file.read()
-            laser_matches = re.findall(r'((?:md|pi)[a-z]{2}\.out)\s+(\d{2}\.\d)\s+(\d+)\s+(MD|PI)', laser_data)
+        input_powers = _get_input_powers()
+        lasers = _get_lasers()
 
-            with ThreadPoolExecutor() as executor:
-                tasks = [
-                    executor.submit(_process, input_powers, Laser(laser[0], float(laser[1]), int(laser[2]), laser[3]))
-                    for laser in laser_matches]
-                wait(tasks, return_when=ALL_COMPLETED)
+        if args.report:
+            rows, max_error, mismatches = accuracy_report(args.report, engine=args.engine, config=config)
+            logging.info(f'{args.engine} engine, {args.quadrature} quadrature '
+                         f'({_quadrature_nodes(args.quadrature, config)} '
+                         f'nodes): {rows} rows, maximum error {max_error:.3g} W, '
+                         f'{mismatches} rows differing at 3 decimals')
+            if args.ring_tolerance:
+                rings = len(_radial_quadrature(args.quadrature, config=config.radial)[0])
+                skipped = rings - len(_radial_quadrature(args.quadrature, args.ring_tolerance, config.radial)[0])
+                logging.info(f'Ring tolerance {args.ring_tolerance}: {skipped} of {rings} rings skipped per point')
+        elif args.sweep:
+            with process_pool(args.workers):
+                table = sweep(lasers, input_powers, rad=args.sweep_rad, w1=args.sweep_w1, dz=args.sweep_dz,
+                              engine=args.engine, config=config)
+            _write_table(args.sweep, table)
+            logging.info(f'{len(table)} rows written to {args.sweep}')
+        elif args.fit:
+            datasets = [_read_measurements(path) for path in args.measurements]
+            with process_pool(args.workers):
+                fits = fit_datasets(datasets, engine=args.engine, config=config)
+            for path, fit in zip(args.measurements, fits):
+                logging.info(f'{path}: small-signal gain {fit.small_signal_gain:.4f}, saturation intensity '
+                             f'{fit.saturation_intensity:.1f}, rms residual {np.sqrt(np.mean(fit.residuals ** 2)):.3g}'
+                             f' W, {fit.evaluations} evaluations')
+            table = _fit_table(args.measurements, datasets, fits)
+            _write_table(args.fit, table)
+            logging.info(f'{len(table)} rows written to {args.fit}')
+        elif args.benchmark:
+            timings = benchmark_scaling(lasers, input_powers, engine=args.engine, config=config)
+            for workers, seconds in timings:
+                logging.info(f'{workers:>4} workers: {seconds:.3f} seconds, speedup {timings[0][1] / seconds:.2f}x')
+            (pair_seconds, pair_integrations), (seconds, integrations) = benchmark_normalisation(
+                lasers, input_powers, config=config)
+            logging.info(f'Transfer tables per (gain, Isat): {pair_integrations} integrations in {pair_seconds:.3f} '
+                         f'seconds; normalised to I/Isat: {integrations} integrations in {seconds:.3f} seconds, '
+                         f'speedup {pair_seconds / seconds:.2f}x')
+        else:
+            cache = ResultCache(args.cache, args.cache_size) if args.cache else None
+            with process_pool(args.workers):
+                grid = _write_reports(lasers, solve_grid_blocks(
+                    lasers, input_powers, engine=args.engine, parallel=True, cache=cache,
+                    low_intensity_tolerance=args.low_intensity_tolerance, config=config), args.consolidate)
+            if args.output:
+                table = results_table(lasers, grid)
+                for path in args.output:
+                    write_results(path, table)
+            if args.low_intensity_tolerance is not None:
+                for laser, results in zip(lasers, grid):
+                    fast_path_powers = sorted(set(results['input_power'][results['fast_path']].tolist()))
+                    logging.info(f'{laser.output_file}: {np.count_nonzero(results["fast_path"])} of {results.size} '
+                                 f'points took the low-intensity fast path (Pin {fast_path_powers})')
+            if cache:
+                logging.info(f'Result cache: {cache.hits} hits, {cache.misses} misses, {len(cache)} entries')
+                cache.close()
 
         logging.info(f'The time was {datetime.datetime.now().timestamp() - start:.3f} seconds')
 
 
-def _process(input_powers, laser):
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='CO2 Laser Saturation Intensity calculation')
+    parser.add_argument('--engine', choices=engines(), default=os.environ.get('SATIN_ENGINE', 'numpy'),
+                        help='calculation engine (default: $SATIN_ENGINE or numpy)')
+    parser.add_argument('--tolerance', type=float, default=ADAPTIVE_TOLERANCE,
+                        help=f'relative error tolerance of the adaptive engine (default: {ADAPTIVE_TOLERANCE})')
+    parser.add_argument('--quadrature', choices=sorted(QUADRATURE_NODES), default=RADIAL_QUADRATURE,
+                        help=f'radial quadrature of the numpy, jit and adaptive engines (default: {RADIAL_QUADRATURE})')
+    parser.add_argument('--ring-tolerance', type=float, default=None, metavar='TOLERANCE',
+                        help='stop the radial sum of the numpy, jit and adaptive engines at the first ring beyond '
+                             'which the outer rings carry at most TOLERANCE of the input power (default: all rings)')
+    parser.add_argument('--low-intensity-tolerance', type=float, nargs='?', const=LOW_INTENSITY_TOLERANCE,
+                        metavar='TOLERANCE',
+                        help='use the closed-form low-intensity solution where its guaranteed relative error is '
+                             f'within TOLERANCE (default when given: {LOW_INTENSITY_TOLERANCE})')
+    model = parser.add_argument_group('model parameters', 'override the built-in or --config model parameters')
+    model.add_argument('--config', metavar='PATH',
+                       help='JSON file of model parameters, e.g. {"rad": 0.2, "saturation_intensities": [10000]}')
+    for field, kind, description in (('rad', float, 'beam radius in cm'), ('w1', float, 'mirror beam waist in cm'),
+                                     ('dr', float, 'ring width in cm'), ('dz', float, 'axial step in cm'),
+                                     ('wavelength', float, 'wavelength in cm'), ('incr', int, 'number of axial steps')):
+        model.add_argument(f'--{field}', type=kind,
+                           help=f'{description} (default: {getattr(DEFAULT_CONFIG, field)})')
+    model.add_argument('--saturation-intensities', type=int, nargs='+', metavar='ISAT',
+                       help='saturation intensities to calculate (default: 10000 to 25000 in steps of 1000)')
+    sweep_parameters = parser.add_argument_group(
+        'sweep', 'solve every combination of the swept parameters, given as values or inclusive START:STOP:STEP '
+                 'ranges, and write the results to one table')
+    sweep_parameters.add_argument('--sweep', metavar='CSV', help='file to write the sweep table to')
+    for field in ('rad', 'w1', 'dz'):
+        sweep_parameters.add_argument(f'--sweep-{field}', type=_parameter_values, nargs='+', metavar='VALUES',
+                                      help=f'values of {field} to sweep')
+    fit = parser.add_argument_group(
+        'fit', 'fit the small-signal gain and saturation intensity to each measurement file, of input and output '
+               'powers one pair per line, and write the parameters and residuals to one table')
+    fit.add_argument('--fit', metavar='CSV', help='file to write the fit table to')
+    fit.add_argument('--measurements', nargs='+', metavar='PATH', help='measurement files to fit')
+    parser.add_argument('--consolidate', metavar='PATH',
+                        help='write the reports of all the lasers to PATH from one thread instead of one file each')
+    parser.add_argument('--output', action='append', metavar='PATH',
+                        help='also write every result to PATH, in the satin-all.csv layout for .csv, or as a table '
+                             'with the laser parameters for .npy and .parquet; may be repeated')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--cache', metavar='PATH',
+                        help='SQLite file caching calculated results between runs')
+    parser.add_argument('--cache-size', type=int, default=1000000,
+                        help='maximum number of cached results (default: 1000000)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='report the grid solve time on 1, 2, 4 ... N workers instead of writing output files')
+    parser.add_argument('--report', metavar='CSV',
+                        help='report the accuracy of the engine against a golden CSV such as satin-all.csv '
+                             'instead of writing output files')
+    args = parser.parse_args(argv)
+    if args.fit and not args.measurements:
+        parser.error('--fit requires --measurements')
+    for field in ('sweep_rad', 'sweep_w1', 'sweep_dz'):
+        if getattr(args, field) is not None:
+            setattr(args, field, list(itertools.chain.from_iterable(getattr(args, field))))
+    return args
+
+
+def _parameter_values(text):
+    if ':' not in text:
+        return [float(text)]
+    start, stop, step = (float(value) for value in text.split(':'))
+    return [round(start + i * step, 12) for i in range(int(round((stop - start) / step)) + 1)]
+
+
+def _get_config(args):
+    config = SatinConfig.load(args.config) if args.config else DEFAULT_CONFIG
+    overrides = {field: getattr(args, field) for field in SatinConfig._fields if getattr(args, field) is not None}
+    if 'saturation_intensities' in overrides:
+        overrides['saturation_intensities'] = tuple(overrides['saturation_intensities'])
+    return config._replace(**overrides)
+
+
+def _process(laser, results):
     with open(f'{laser.output_file}', 'w', encoding='utf-8') as file:
         file.write(f'Start date: {datetime.datetime.now().isoformat()}\n')
         file.write(textwrap.dedent(f'''
@@ -66,16 +534,9 @@ def _process(input_powers, laser):
             (watts)   (watts)              (watts/cm2)                  (watts)
         '''))
 
-        lines = [
-            f'{gaussian.input_power:<10}'
-            f'{gaussian.output_power:<21.14f}'
-            f'{gaussian.saturation_intensity:<14}'
-            f'{math.log(gaussian.output_power / gaussian.input_power):>5.3f}'
-            f'{gaussian.output_power - gaussian.input_power:>16.3f}\n'
-            for input_power in input_powers
-            for gaussian in gaussian_calculation(input_power, laser.small_signal_gain)
-        ]
-        file.writelines(lines)
+        for input_power_results in results:
+            file.writelines(_report_lines(input_power_results))
+            file.flush()
 
         file.write(f'\nEnd date: {datetime.datetime.now().isoformat()}')
         file.flush()
@@ -83,36 +544,1120 @@ def _process(input_powers, laser):
     return file.name
 
 
+def _process_all(output_file, lasers, grids):
+    width = max([len(str(laser.output_file)) + 2 for laser in lasers] + [14])
+    with open(output_file, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as file:
+        file.write(f'Start date: {datetime.datetime.now().isoformat()}\n\nGaussian Beam\n\n')
+        file.write(f'{"Laser":<{width}}Pressure in Main Discharge   Small-signal Gain   CO2 via\n'
+                   f'{"":<{width}}(kPa)\n')
+        file.writelines(f'{laser.output_file!s:<{width}}{laser.discharge_pressure!s:<29}'
+                        f'{laser.small_signal_gain!s:<20}{laser.carbon_dioxide}\n' for laser in lasers)
+        file.write(f'\n{"Laser":<{width}}Pin       Pout                 Sat. Int      ln(Pout/Pin)   Pout-Pin\n'
+                   f'{"":<{width}}(watts)   (watts)              (watts/cm2)                  (watts)\n')
+
+        for grid in grids:
+            for laser, results in zip(lasers, grid):
+                file.writelines(f'{laser.output_file!s:<{width}}{line}' for line in _report_lines(results))
+            file.flush()
+
+        file.write(f'\nEnd date: {datetime.datetime.now().isoformat()}')
+
+    return file.name
+
+
+def _report_lines(results):
+    return (
+        f'{gaussian.input_power:<10}'
+        f'{gaussian.output_power:<21.14f}'
+        f'{gaussian.saturation_intensity:<14}'
+        f'{math.log(gaussian.output_power / gaussian.input_power):>5.3f}'
+        f'{gaussian.output_power - gaussian.input_power:>16.3f}\n'
+        for gaussian in _gaussians(results)
+    )
+
+
+def _write_reports(lasers, blocks, output_file=None):
+    # The reports are written by their own threads as the blocks of input powers arrive, in order, with at
+    # most WRITE_QUEUE_SIZE blocks waiting for each thread: one per laser, or with an output_file a single
+    # thread writing every laser to it. Returns the whole grid.
+    queues = [queue.Queue(maxsize=WRITE_QUEUE_SIZE) for _ in (lasers if output_file is None else [output_file])]
+    grids = []
+    with ThreadPoolExecutor(max_workers=max(1, len(queues))) as executor:
+        if output_file is None:
+            tasks = [executor.submit(_process, laser, itertools.chain.from_iterable(_drain(laser_queue)))
+                     for laser, laser_queue in zip(lasers, queues)]
+        else:
+            tasks = [executor.submit(_process_all, output_file, lasers, _drain(queues[0]))]
+        try:
+            for grid in blocks:
+                grids.append(grid)
+                for results, task_queue, task in zip(grid if output_file is None else [grid], queues, tasks):
+                    _put(task_queue, results, task)
+        finally:
+            for task_queue, task in zip(queues, tasks):
+                _put(task_queue, None, task)
+        for task in tasks:
+            task.result()
+    return np.concatenate(grids, axis=1)
+
+
+def _drain(task_queue):
+    # yield the items put on the queue up to the closing None
+    while True:
+        item = task_queue.get()
+        if item is None:
+            return
+        yield item
+
+
+def _put(task_queue, item, task):
+    # a writer that has failed stops draining its queue, so raise its error instead of waiting forever
+    while True:
+        try:
+            task_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            if task.done():
+                task.result()
+                return
+
+
+def results_table(lasers, grid):
+    """Flatten a solve_grid result into a table with a row for each laser, input power and saturation
+    intensity.
+
+    The fields are the laser's output_file, small_signal_gain, discharge_pressure and carbon_dioxide, then
+    input_power, saturation_intensity, output_power, log_power_ratio, ln(Pout/Pin), and power_difference,
+    Pout - Pin.
+    """
+    points = grid.shape[1] * grid.shape[2]
+    table = np.empty(grid.size, dtype=[
+        ('output_file', f'U{max([len(str(laser.output_file)) for laser in lasers] + [1])}'),
+        ('small_signal_gain', 'f8'),
+        ('discharge_pressure', 'i8'),
+        ('carbon_dioxide', 'U2'),
+        ('input_power', grid.dtype['input_power']),
+        ('saturation_intensity', grid.dtype['saturation_intensity']),
+        ('output_power', 'f8'),
+        ('log_power_ratio', 'f8'),
+        ('power_difference', 'f8'),
+    ])
+    table['output_file'] = np.repeat([str(laser.output_file) for laser in lasers], points)
+    table['discharge_pressure'] = np.repeat([laser.discharge_pressure for laser in lasers], points)
+    table['carbon_dioxide'] = np.repeat([laser.carbon_dioxide for laser in lasers], points)
+    for name in ('small_signal_gain', 'input_power', 'saturation_intensity', 'output_power'):
+        table[name] = grid[name].reshape(-1)
+    table['log_power_ratio'] = np.log(table['output_power'] / table['input_power'])
+    table['power_difference'] = table['output_power'] - table['input_power']
+    return table
+
+
+def write_results(path, table):
+    """Write a results_table to path in the format its extension names.
+
+    .csv writes the satin-all.csv columns: input power, small-signal gain, saturation intensity and output
+    power, ln(Pout/Pin) and Pout - Pin to 3 decimals. .npy writes the table itself, which np.load can
+    memory-map, and .parquet writes it as a Parquet file, which requires pyarrow to be installed.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        np.savetxt(path, table[['input_power', 'small_signal_gain', 'saturation_intensity', 'output_power',
+                                'log_power_ratio', 'power_difference']], fmt='%s,%s,%s,%.3f,%.3f,%.3f')
+    elif extension == '.npy':
+        np.save(path, table)
+    elif extension == '.parquet':
+        if pyarrow is None:
+            raise RuntimeError('Parquet output requires pyarrow to be installed')
+        pyarrow.parquet.write_table(pyarrow.table({name: table[name] for name in table.dtype.names}), path)
+    else:
+        raise ValueError(f'Unknown results format {extension!r}, expected .csv, .npy or .parquet')
+
+
+def _get_lasers():
+    with open(LASER_FILE, encoding='utf-8') as laser_file:
+        laser_matches = re.findall(r'((?:md|pi)[a-z]{2}\.out)\s+(\d{2}\.\d)\s+(\d+)\s+(MD|PI)', laser_file.read())
+        return [Laser(laser[0], float(laser[1]), int(laser[2]), laser[3]) for laser in laser_matches]
+
+
 def _get_input_powers():
     with open(PIN_FILE, encoding='utf-8') as pin_file:
         return [int(match.group()) for match in re.finditer(r'\d+', pin_file.read())]
 
 
-def gaussian_calculation(input_power, small_signal_gain):
-    saturation_intensities = range(10000, 25001, 1000)
+def _read_measurements(path):
+    # input and output powers separated by whitespace or a comma, skipping blank lines and # comments
+    with open(path, encoding='utf-8') as file:
+        rows = [[float(value) for value in re.split(r'[\s,]+', line.strip())[:2]] for line in file
+                if line.strip() and not line.startswith('#')]
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def _fit_table(paths, datasets, fits):
+    # a row per measurement with the parameters fitted to its file and its residual
+    table = np.empty(sum(len(input_powers) for input_powers, _ in datasets), dtype=[
+        ('file', f'U{max(map(len, paths))}'), ('small_signal_gain', 'f8'), ('saturation_intensity', 'f8'),
+        ('input_power', 'f8'), ('output_power', 'f8'), ('residual', 'f8')])
+    start = 0
+    for path, (input_powers, output_powers), fit in zip(paths, datasets, fits):
+        rows = table[start:start + len(input_powers)]
+        rows['file'], rows['small_signal_gain'], rows['saturation_intensity'] = path, fit.small_signal_gain, \
+            fit.saturation_intensity
+        rows['input_power'], rows['output_power'], rows['residual'] = input_powers, output_powers, fit.residuals
+        start += len(input_powers)
+    return table
+
+
+def _gaussians(results):
+    return [Gaussian(*values) for values in
+            results[['input_power', 'output_power', 'saturation_intensity']].reshape(-1).tolist()]
+
+
+def solve_grid(lasers, input_powers, saturation_intensities=None, engine='numpy', parallel=False, cache=None,
+               low_intensity_tolerance=None, config=None):
+    """Calculate the output power for every laser, input power and saturation intensity.
+
+    Returns a structured array of shape (lasers, input powers, saturation intensities) with the fields
+    small_signal_gain, input_power, saturation_intensity, output_power and fast_path. The grid is solved
+    in one pass, or with parallel=True split into chunks of work units spread over the shared process pool.
+    With a ResultCache only the points missing from the cache are calculated. With a
+    low_intensity_tolerance, points whose closed-form low-intensity estimate is guaranteed to be within
+    that relative error are not integrated, and are flagged in fast_path. The saturation intensities and
+    other model parameters default to those of config, itself defaulting to DEFAULT_CONFIG.
+    """
+    if np is None:
+        raise RuntimeError('solve_grid requires numpy to be installed')
+    small_signal_gains = np.array([laser.small_signal_gain for laser in lasers], dtype=float)
+    input_powers = np.asarray(input_powers)
+    if saturation_intensities is None:
+        saturation_intensities = (config or DEFAULT_CONFIG).saturation_intensities
+    saturation_intensities = np.asarray(saturation_intensities)
+
+    grid = np.empty((len(small_signal_gains), len(input_powers), len(saturation_intensities)), dtype=[
+        ('small_signal_gain', 'f8'),
+        ('input_power', input_powers.dtype),
+        ('saturation_intensity', saturation_intensities.dtype),
+        ('output_power', 'f8'),
+        ('fast_path', '?'),
+    ])
+    grid['fast_path'] = False
+    grid['small_signal_gain'] = small_signal_gains[:, np.newaxis, np.newaxis]
+    grid['input_power'] = input_powers[np.newaxis, :, np.newaxis]
+    grid['saturation_intensity'] = saturation_intensities[np.newaxis, np.newaxis, :]
+    _solve_cached(engine, grid.reshape(-1), parallel, cache, low_intensity_tolerance, config)
+    return grid
+
+
+def _solve_cached(engine, units, parallel, cache=None, low_intensity_tolerance=None, config=None):
+    if cache is None:
+        _solve(engine, units, parallel, low_intensity_tolerance, config)
+        return
+
+    keys = units[['input_power', 'small_signal_gain', 'saturation_intensity']].tolist()
+    cached_output_powers = cache.get_many(_engine_key(engine), keys, config)
+    missing = np.array([output_power is None for output_power in cached_output_powers], dtype=bool)
+    units['output_power'][~missing] = [output_power for output_power in cached_output_powers
+                                       if output_power is not None]
+    pending = units[missing]
+    _solve(engine, pending, parallel, low_intensity_tolerance, config)
+    units['output_power'][missing] = pending['output_power']
+    units['fast_path'][missing] = pending['fast_path']
+    # low-intensity estimates are not cached, so that they are never served as calculated results
+    calculated = missing.copy()
+    calculated[missing] = ~pending['fast_path']
+    cache.put_many(_engine_key(engine), [key for key, is_calculated in zip(keys, calculated) if is_calculated],
+                   pending['output_power'][~pending['fast_path']].tolist(), config)
+
+
+def solve_grid_blocks(lasers, input_powers, saturation_intensities=None, block_size=None, **options):
+    """Solve the grid in consecutive blocks of input powers, yielding the solve_grid result of each block as
+    soon as it has been calculated.
+
+    block_size defaults to as many input powers as make about BLOCK_POINTS points per block. options are
+    passed on to solve_grid.
+    """
+    if saturation_intensities is None:
+        saturation_intensities = (options.get('config') or DEFAULT_CONFIG).saturation_intensities
+    input_powers = list(input_powers)
+    if block_size is None:
+        block_size = max(1, BLOCK_POINTS // max(1, len(lasers) * len(saturation_intensities)))
+    for i in range(0, len(input_powers), block_size):
+        yield solve_grid(lasers, input_powers[i:i + block_size], saturation_intensities, **options)
+
+
+def _solve(engine, units, parallel, low_intensity_tolerance=None, config=None):
+    if len(units) == 0 or low_intensity_tolerance is None:
+        _solve_unique(engine, units, parallel, config)
+        return
+    output_powers, error_bounds = _low_intensity_output_powers(
+        units['input_power'], units['small_signal_gain'], units['saturation_intensity'], config)
+    fast_path = error_bounds <= low_intensity_tolerance * output_powers
+    units['output_power'][fast_path] = output_powers[fast_path]
+    units['fast_path'] = fast_path
+    pending = units[~fast_path]
+    _solve_unique(engine, pending, parallel, config)
+    units['output_power'][~fast_path] = pending['output_power']
+
+
+def _solve_unique(engine, units, parallel, config=None):
+    if len(units) == 0:
+        return
+    _, first, inverse = np.unique(
+        np.column_stack((units['input_power'], units['small_signal_gain'], units['saturation_intensity'])),
+        axis=0, return_index=True, return_inverse=True)
+    if len(first) < len(units):
+        distinct_units = units[first]
+        _solve_distinct(engine, distinct_units, parallel, config)
+        units['output_power'] = distinct_units['output_power'][inverse.reshape(-1)]
+    else:
+        _solve_distinct(engine, units, parallel, config)
+
+
+def _solve_distinct(engine, units, parallel, config=None):
+    if not parallel:
+        units['output_power'] = _solve_units(engine, units['input_power'], units['small_signal_gain'],
+                                             units['saturation_intensity'], config)
+        return
+
+    chunksize = max(1, math.ceil(len(units) / (_shared_executor.max_workers * CHUNKS_PER_WORKER)))
+    chunks = [units[i:i + chunksize] for i in range(0, len(units), chunksize)]
+    executor = get_executor()
+    futures = [
+        executor.submit(_solve_units, engine, chunk['input_power'], chunk['small_signal_gain'],
+                        chunk['saturation_intensity'], config) for chunk in chunks]
+    wait(futures, return_when=ALL_COMPLETED)
+    for chunk, future in zip(chunks, futures):
+        chunk['output_power'] = future.result()
+
+
+def _solve_units(engine, input_powers, small_signal_gains, saturation_intensities, config=None):
+    engine = _get_engine(engine)
+    options = {} if config is None else {'config': config}
+    if engine.calculate_output_powers is not None:
+        return engine.calculate_output_powers(input_powers, small_signal_gains, saturation_intensities, **options)
+    return [engine.calculate_output_power(*unit, **options) for unit in
+            zip(_to_list(input_powers), _to_list(small_signal_gains), _to_list(saturation_intensities))]
+
+
+def _to_list(values):
+    return values.tolist() if hasattr(values, 'tolist') else list(values)
 
-    with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-        futures = [
-            executor.submit(_calculate_output_power, input_power, small_signal_gain, saturation_intensity) for
-            saturation_intensity in saturation_intensities]
-        wait(futures, return_when=ALL_COMPLETED)
-        return [Gaussian(input_power, future.result(), saturation_intensity) for future, saturation_intensity in
-                zip(futures, saturation_intensities)]
 
+def sweep(lasers, input_powers, rad=None, w1=None, dz=None, engine='numpy', config=None):
+    """Solve the grid for every combination of the given beam radii, mirror beam waists and axial steps.
 
-def _calculate_output_power(input_power, small_signal_gain, saturation_intensity):
-    input_intensity = 2 * input_power / AREA
-    expr2 = saturation_intensity * small_signal_gain / 32000 * DZ
+    Parameters not swept keep the values of config, which defaults to DEFAULT_CONFIG. Every configuration
+    and laser is a separate task on the shared process pool, and configurations that share the radial or
+    axial parameters share those tables in each worker. Returns one structured array with the fields rad,
+    w1 and dz followed by those of solve_grid, with a row for each configuration, laser, input power and
+    saturation intensity.
+    """
+    config = config or DEFAULT_CONFIG
+    configs = [config._replace(rad=beam_radius, w1=beam_waist, dz=axial_step) for beam_radius, beam_waist, axial_step
+               in itertools.product(rad or [config.rad], w1 or [config.w1], dz or [config.dz])]
+    executor = get_executor()
+    tasks = [(config, executor.submit(solve_grid, [laser], input_powers, engine=engine, config=config))
+             for config in configs for laser in lasers]
+    wait([future for _, future in tasks], return_when=ALL_COMPLETED)
+    parts = []
+    for config, future in tasks:
+        grid = future.result().reshape(-1)
+        part = np.empty(len(grid), dtype=[('rad', 'f8'), ('w1', 'f8'), ('dz', 'f8')] + grid.dtype.descr)
+        part['rad'], part['w1'], part['dz'] = config.rad, config.w1, config.dz
+        for name in grid.dtype.names:
+            part[name] = grid[name]
+        parts.append(part)
+    return np.concatenate(parts)
+
+
+def _write_table(path, table):
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())
+
+
+def benchmark_scaling(lasers, input_powers, saturation_intensities=None, engine='numpy', worker_counts=None,
+                      config=None):
+    """Time solve_grid on process pools of increasing size.
+
+    worker_counts defaults to 1, 2, 4 ... up to the number of CPUs. Returns a list of (workers, seconds).
+    """
+    if worker_counts is None:
+        cpu_count = multiprocessing.cpu_count()
+        worker_counts = sorted({2 ** i for i in range(cpu_count.bit_length()) if 2 ** i < cpu_count} | {cpu_count})
+    timings = []
+    for workers in worker_counts:
+        with process_pool(workers):
+            start = datetime.datetime.now().timestamp()
+            solve_grid(lasers, input_powers, saturation_intensities, engine=engine, parallel=True, config=config)
+            timings.append((workers, datetime.datetime.now().timestamp() - start))
+    return timings
+
+
+def benchmark_normalisation(lasers, input_powers, saturation_intensities=None, config=None):
+    """Time the transfer engine on the grid with a table per (gain, saturation intensity) pair and with tables
+    in I / Isat shared by every saturation intensity.
+
+    Returns ((seconds, integrations) per pair, (seconds, integrations) normalised).
+    """
+    if saturation_intensities is None:
+        saturation_intensities = (config or DEFAULT_CONFIG).saturation_intensities
+    units = np.array(list(itertools.product([laser.small_signal_gain for laser in lasers], input_powers,
+                                            saturation_intensities)), dtype=float).reshape(-1, 3)
+    timings = []
+    for normalise in (False, True):
+        start = datetime.datetime.now().timestamp()
+        integrations = _solve_transfer(units[:, 1], units[:, 0], units[:, 2], config=config, normalise=normalise)[1]
+        timings.append((datetime.datetime.now().timestamp() - start, integrations))
+    return tuple(timings)
+
+
+def accuracy_report(csv_path, engine='numpy', config=None):
+    """Compare the engine against a golden CSV of input power, small-signal gain, saturation intensity and
+    output power rows.
+
+    Returns the number of rows, the largest absolute output power error and the number of rows whose output
+    power differs once rounded to 3 decimals.
+    """
+    with open(csv_path, newline='', encoding='utf-8') as csv_file:
+        rows = list(csv.reader(csv_file))
+    expected = [float(row[3]) for row in rows]
+    output_powers = _to_list(_solve_units(engine, [int(row[0]) for row in rows], [float(row[1]) for row in rows],
+                                          [int(row[2]) for row in rows], config))
+    max_error = max(abs(output_power - golden) for output_power, golden in zip(output_powers, expected))
+    mismatches = sum(round(output_power, 3) != golden for output_power, golden in zip(output_powers, expected))
+    return len(rows), max_error, mismatches
+
+
+def calculate_point(input_power, small_signal_gain, saturation_intensity, engine='pure', config=None):
+    """Return the Gaussian for a single saturation intensity."""
+    return gaussian_calculation(input_power, small_signal_gain, engine=engine, config=config,
+                                saturation_intensities=(saturation_intensity,))[0]
+
+
+def gaussian_calculation(input_power, small_signal_gain, engine='pure', batched=False, config=None,
+                         saturation_intensities=None):
+    if saturation_intensities is None:
+        saturation_intensities = (config or DEFAULT_CONFIG).saturation_intensities
+    saturation_intensities = tuple(saturation_intensities)
+
+    if batched:
+        output_powers = _solve_units(engine, [input_power] * len(saturation_intensities),
+                                     [small_signal_gain] * len(saturation_intensities), saturation_intensities, config)
+        return [Gaussian(input_power, float(output_power), saturation_intensity) for output_power, saturation_intensity
+                in zip(output_powers, saturation_intensities)]
+
+    calculate_output_power = _get_engine(engine).calculate_output_power
+    options = {} if config is None else {'config': config}
+    executor = get_executor()
+    futures = [
+        _memo.get_or_submit(
+            (engine, config or DEFAULT_CONFIG, input_power, small_signal_gain, saturation_intensity),
+            lambda saturation_intensity=saturation_intensity: executor.submit(
+                calculate_output_power, input_power, small_signal_gain, saturation_intensity, **options))
+        for saturation_intensity in saturation_intensities]
+    wait(futures, return_when=ALL_COMPLETED)
+    return [Gaussian(input_power, future.result(), saturation_intensity) for future, saturation_intensity in
+            zip(futures, saturation_intensities)]
+
+
+def solve_saturation_intensity(input_power, output_power, small_signal_gain, bracket=None, tolerance=None,
+                               engine=None, cache=None, config=None):
+    """Find the saturation intensity at which the model gives the measured output power.
+
+    The output power rises with the saturation intensity, so the root is bracketed by bracket, a (lower,
+    upper) pair of saturation intensities defaulting to the range of the config's, doubled outwards until it
+    encloses the measured output power, and then found by Brent's method to the relative tolerance. Without
+    an engine output powers are interpolated from a transfer table of the small-signal gain in I / Isat,
+    built once for the whole bracket, so that each iteration costs an interpolation rather than an
+    integration. With one they are calculated by the engine, through the ResultCache if one is given.
+    Returns an Inversion with the saturation intensity, the output power the model gives there and the
+    number of output powers evaluated.
+    """
+    if np is None:
+        raise RuntimeError('solve_saturation_intensity requires numpy to be installed')
+    tolerance = tolerance or INVERSE_TOLERANCE
+    config = config or DEFAULT_CONFIG
+    output_power = float(output_power)
+    lower, upper = (float(limit) for limit in bracket or (min(config.saturation_intensities),
+                                                         max(config.saturation_intensities)))
+    calculated = {}
+    covered, transfer = (math.inf, -math.inf), None
+
+    def residuals(*saturation_intensities):
+        nonlocal covered, transfer
+        pending = [saturation_intensity for saturation_intensity in saturation_intensities
+                   if saturation_intensity not in calculated]
+        if pending and engine is not None:
+            grid = solve_grid([Laser(None, small_signal_gain, None, None)], [input_power], pending, engine=engine,
+                              cache=cache, config=config)
+            calculated.update(zip(pending, grid['output_power'].reshape(-1).tolist()))
+        elif pending:
+            if min(pending) < covered[0] or max(pending) > covered[1]:
+                covered = min(covered[0], *pending), max(covered[1], *pending)
+                transfer = _transfer_function(input_power, small_signal_gain, *covered, config)
+            calculated.update(zip(pending, map(transfer, pending)))
+        return [calculated[saturation_intensity] - output_power for saturation_intensity in saturation_intensities]
+
+    lower_residual, upper_residual = residuals(lower, upper)
+    for _ in range(INVERSE_BRACKET_EXPANSIONS):
+        if lower_residual <= 0 <= upper_residual:
+            break
+        if lower_residual > 0:
+            lower /= 2
+            lower_residual, = residuals(lower)
+        else:
+            upper *= 2
+            upper_residual, = residuals(upper)
+    if not lower_residual <= 0 <= upper_residual:
+        raise ValueError(f'No saturation intensity between {lower} and {upper} gives an output power of '
+                         f'{output_power} from an input power of {input_power}')
+    saturation_intensity = _brent(lambda x: residuals(x)[0], lower, upper, lower_residual, upper_residual,
+                                  tolerance)
+    return Inversion(saturation_intensity, calculated[saturation_intensity], len(calculated))
+
+
+def fit_parameters(input_powers, output_powers, small_signal_gain=None, saturation_intensity=None, tolerance=None,
+                   engine='numpy', cache=None, config=None):
+    """Fit the small-signal gain and saturation intensity to measured input and output powers by least squares.
+
+    The fit is Levenberg-Marquardt over the logs of the two parameters, starting from small_signal_gain,
+    by default the gain that the least saturated measurement would have without saturation, and from
+    saturation_intensity, by default the median of the config's. Each iteration calculates the output
+    power of every measurement at the trial parameters and at each of them stepped by FIT_STEP for the
+    Jacobian in one batched engine call, looked up in the ResultCache first if one is given, and the fit
+    stops once an accepted step changes the parameters by less than the relative tolerance. Returns a Fit
+    with the parameters, the residuals (model less measured output powers) and the number of output powers
+    calculated.
+    """
+    if np is None:
+        raise RuntimeError('fit_parameters requires numpy to be installed')
+    tolerance = tolerance or FIT_TOLERANCE
+    config = config or DEFAULT_CONFIG
+    input_powers = np.asarray(input_powers, dtype=float)
+    output_powers = np.asarray(output_powers, dtype=float)
+    if small_signal_gain is None:
+        # log(output / input) of an unsaturated beam is about the sum over the axial steps of k - EXPR1[j]
+        small_signal_gain = 32000 / config.dz / config.incr * (
+            math.log(np.max(output_powers / input_powers)) + float(np.sum(_axial_coefficients(config.axial))))
+    if saturation_intensity is None:
+        saturation_intensity = float(np.median(config.saturation_intensities))
+    units = np.empty(3 * len(input_powers), dtype=[
+        ('small_signal_gain', 'f8'), ('input_power', 'f8'), ('saturation_intensity', 'f8'), ('output_power', 'f8'),
+        ('fast_path', '?')])
+    units['input_power'] = np.tile(input_powers, 3)
+    units['fast_path'] = False
+    steps = np.repeat([[0.0, 0.0], [FIT_STEP, 0.0], [0.0, FIT_STEP]], len(input_powers), axis=0)
+
+    evaluations = 0
+
+    def residuals_and_jacobian(log_parameters):
+        nonlocal evaluations
+        units['small_signal_gain'], units['saturation_intensity'] = np.exp(log_parameters + steps).T
+        hits = cache.hits if cache is not None else 0
+        _solve_cached(engine, units, False, cache, config=config)
+        evaluations += len(units) - (cache.hits - hits if cache is not None else 0)
+        model_output_powers = units['output_power'].reshape(3, -1)
+        return model_output_powers[0] - output_powers, ((model_output_powers[1:] - model_output_powers[0]) / FIT_STEP).T
+
+    log_parameters = np.log([small_signal_gain, saturation_intensity])
+    residuals, jacobian = residuals_and_jacobian(log_parameters)
+    damping = 1e-3
+    for _ in range(FIT_ITERATIONS):
+        normal = jacobian.T @ jacobian
+        step = np.linalg.solve(normal + damping * np.diag(np.diag(normal)), -jacobian.T @ residuals)
+        trial_residuals, trial_jacobian = residuals_and_jacobian(log_parameters + step)
+        if trial_residuals @ trial_residuals <= residuals @ residuals:
+            log_parameters = log_parameters + step
+            residuals, jacobian = trial_residuals, trial_jacobian
+            damping /= 10
+        else:
+            damping *= 10
+        if np.max(np.abs(step)) < tolerance:
+            break
+    small_signal_gain, saturation_intensity = np.exp(log_parameters).tolist()
+    return Fit(small_signal_gain, saturation_intensity, residuals, evaluations)
+
+
+def fit_datasets(datasets, engine='numpy', config=None):
+    """Fit each (input powers, output powers) dataset with fit_parameters as a separate task on the shared
+    process pool, and return the Fit of each."""
+    executor = get_executor()
+    futures = [executor.submit(fit_parameters, input_powers, output_powers, engine=engine, config=config)
+               for input_powers, output_powers in datasets]
+    wait(futures, return_when=ALL_COMPLETED)
+    return [future.result() for future in futures]
+
+
+def _brent(f, a, b, fa, fb, tolerance):
+    # Brent's method, as in scipy's brentq, for the root of f between a and b where fa and fb differ in sign,
+    # to within the relative tolerance
+    previous, current, f_previous, f_current = a, b, fa, fb
+    if f_previous == 0:
+        return previous
+    block = f_block = step = previous_step = 0
+    while True:
+        if f_previous * f_current < 0:
+            block, f_block = previous, f_previous
+            step = previous_step = current - previous
+        if abs(f_block) < abs(f_current):
+            previous, current, block = current, block, current
+            f_previous, f_current, f_block = f_current, f_block, f_current
+        delta = tolerance * abs(current) / 2
+        bisection = (block - current) / 2
+        if f_current == 0 or abs(bisection) < delta:
+            return current
+        if abs(previous_step) > delta and abs(f_current) < abs(f_previous):
+            if previous == block:
+                trial = -f_current * (current - previous) / (f_current - f_previous)
+            else:
+                slope_previous = (f_previous - f_current) / (previous - current)
+                slope_block = (f_block - f_current) / (block - current)
+                trial = -f_current * (f_block * slope_block - f_previous * slope_previous) / (
+                    slope_block * slope_previous * (f_block - f_previous))
+            if 2 * abs(trial) < min(abs(previous_step), 3 * abs(bisection) - delta):
+                previous_step, step = step, trial
+            else:
+                previous_step = step = bisection
+        else:
+            previous_step = step = bisection
+        previous, f_previous = current, f_current
+        current += step if abs(step) > delta else math.copysign(delta, bisection)
+        f_current = f(current)
+
+
+def __getattr__(name):
+    # EXPR1 is built on first use rather than when the module is imported
+    if name == 'EXPR1':
+        return _axial_coefficients(DEFAULT_CONFIG)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+@lru_cache(maxsize=None)
+def _axial_coefficients(config):
+    """Return EXPR1, the beam expansion term of each axial step, as a read-only contiguous array of doubles."""
+    incr, dz, z12 = config.incr, config.dz, config.z12
+    return _table('expr1', config, lambda: array('d', (
+        2 * ((i - incr // 2) / 25) * dz / (z12 + ((i - incr // 2) / 25) ** 2) for i in range(incr))))
+
+
+def _table_key(name, config):
+    return f'{name}-{model_hash(config)}'
+
+
+def _table(name, config, build):
+    # Tables are numpy arrays when numpy is installed, attached to shared memory in pool workers, memory-mapped
+    # from TABLE_CACHE when that is set so that every process maps the same pages, and array('d') buffers
+    # otherwise.
+    key = _table_key(name, config)
+    if key in _attached_tables:
+        return _attached_tables[key]
+    if np is None:
+        return build()
+    if not TABLE_CACHE:
+        table = np.array(build(), dtype=float)
+        table.flags.writeable = False
+        return table
+    path = os.path.join(TABLE_CACHE, f'{key}.npy')
+    if not os.path.exists(path):
+        os.makedirs(TABLE_CACHE, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=TABLE_CACHE, suffix='.npy', delete=False) as file:
+            np.save(file, np.asarray(build(), dtype=float))
+        os.replace(file.name, path)
+    return np.load(path, mmap_mode='r')
+
+
+def _calculate_output_power(input_power, small_signal_gain, saturation_intensity, config=None):
+    config = config or DEFAULT_CONFIG
+    input_intensity = 2 * input_power / config.area
+    expr2 = saturation_intensity * small_signal_gain / 32000 * config.dz
+    expr1 = _axial_coefficients(config.axial).tolist()
     return sum(
         (
             reduce(
                 lambda output_intensity, j: output_intensity * (
-                        1 + expr2 / (saturation_intensity + output_intensity) - EXPR1[j]
-                ), range(INCR), input_intensity * math.exp(-2 * r ** 2 / RAD2),
-            ) * EXPR * r for r in (i * DR for i in range(int(0.5 / DR)))
+                        1 + expr2 / (saturation_intensity + output_intensity) - expr1[j]
+                ), range(config.incr), input_intensity * math.exp(-2 * r ** 2 / config.rad2),
+            ) * config.expr * r for r in (i * config.dr for i in range(config.rings))
         )
     )
 
 
+def _calculate_output_power_numpy(input_power, small_signal_gain, saturation_intensity, quadrature=None,
+                                  ring_tolerance=None, config=None):
+    return float(_integrate_numpy(input_power, small_signal_gain, saturation_intensity, quadrature, ring_tolerance,
+                                  config))
+
+
+@lru_cache(maxsize=None)
+def _radial_quadrature(quadrature=None, ring_tolerance=None, config=None):
+    """Return the ring radii and weights that sum the output intensity to the output power.
+
+    With a ring_tolerance the outer rings are dropped for as long as their combined share of the input
+    power stays within that relative tolerance.
+    """
+    radii, weights = _full_radial_quadrature(quadrature, config)
+    if ring_tolerance:
+        contributions = weights * _radial_profile(quadrature, config=config)
+        tail = np.cumsum(np.abs(contributions[::-1]))[::-1]
+        kept = np.count_nonzero(tail > ring_tolerance * np.sum(contributions))
+        radii, weights = radii[:kept], weights[:kept]
+    return radii, weights
+
+
+@lru_cache(maxsize=None)
+def _radial_profile(quadrature=None, ring_tolerance=None, config=None):
+    """Return the input beam's relative intensity exp(-2 * r ** 2 / RAD2) at each ring of the quadrature."""
+    radii = _radial_quadrature(quadrature, ring_tolerance, config)[0]
+    profile = np.exp(-2 * radii ** 2 / (config or DEFAULT_CONFIG).rad2)
+    profile.flags.writeable = False
+    return profile
+
+
+@lru_cache(maxsize=None)
+def _full_radial_quadrature(quadrature=None, config=None):
+    """Return the ring radii and weights of the named quadrature.
+
+    rectangle is the left rectangle rule over int(0.5 / DR) rings that defines the model. The others
+    integrate the same range with far fewer rings and subtract the rectangle rule's Euler-Maclaurin error,
+    pi * DR ** 2 / 6 times the intensity on the axis, so that they reproduce it: simpson is Simpson's rule
+    in r, legendre is Gauss-Legendre and laguerre Gauss-Laguerre in s = 2 * r ** 2 / RAD2, in which the
+    input beam is exp(-s).
+    """
+    if np is None:
+        raise RuntimeError('Radial quadratures require numpy to be installed')
+    quadrature = quadrature or RADIAL_QUADRATURE
+    config = config or DEFAULT_CONFIG
+    if quadrature not in QUADRATURE_NODES:
+        raise ValueError(f'Unknown radial quadrature {quadrature!r}')
+    nodes = _quadrature_nodes(quadrature, config)
+    rad2, dr = config.rad2, config.dr
+    radius = config.rings * dr
+    max_s = 2 * radius ** 2 / rad2
+    if quadrature == 'rectangle':
+        radii = np.arange(nodes) * dr
+        return _read_only(radii, config.expr * radii)
+    if quadrature == 'simpson':
+        radii = np.linspace(0, radius, nodes)
+        coefficients = np.ones(nodes)
+        coefficients[1:-1:2] = 4
+        coefficients[2:-1:2] = 2
+        # the axis ring carries no weight in r and is replaced by the correction ring below
+        radii, weights = radii[1:], (radii[1] / 3 * coefficients * 2 * PI * radii)[1:]
+    elif quadrature == 'legendre':
+        s, weights = np.polynomial.legendre.leggauss(nodes)
+        s, weights = (s + 1) * max_s / 2, weights * max_s / 2
+        radii, weights = np.sqrt(s * rad2 / 2), PI * rad2 / 2 * weights
+    elif quadrature == 'laguerre':
+        s, weights = np.polynomial.laguerre.laggauss(nodes)
+        s, weights = s[s < max_s], weights[s < max_s]
+        # the last ring removes the tail beyond the model's outer radius
+        radii = np.append(np.sqrt(s * rad2 / 2), radius)
+        weights = np.append(PI * rad2 / 2 * weights * np.exp(s), -PI * rad2 / 2)
+    return _read_only(np.insert(radii, 0, 0.0), np.insert(weights, 0, -PI * dr ** 2 / 6))
+
+
+def _quadrature_nodes(quadrature, config):
+    return config.rings if quadrature == 'rectangle' else QUADRATURE_NODES[quadrature]
+
+
+def _read_only(*tables):
+    # cached tables are shared by every caller, so they are protected from being modified in place
+    for table in tables:
+        table.flags.writeable = False
+    return tables
+
+
+@lru_cache(maxsize=None)
+def _low_intensity_coefficients(small_signal_gain, config):
+    # With x = intensity / saturation_intensity, each axial step multiplies the intensity by
+    # exp(phi_j(x)), phi_j(x) = log(1 - EXPR1[j] + k / (1 + x)), which is decreasing and convex in x.
+    # Expanding log(output / input) = log(L_N) + eta around x = 0 along the unsaturated trajectory L_j
+    # gives eta = a x0 + b x0 ** 2 + O(x0 ** 3), and convexity brackets eta between a x0 and
+    # (a x0 + 2 B x0 ** 2) exp(a x0), with B = sum(k L_j ** 2 / (1 + k - EXPR1[j])).
+    k = small_signal_gain / 32000 * config.dz
+    step_gain = 1 + k - _axial_coefficients(config)
+    log_unsaturated_gain = np.concatenate(([0.0], np.cumsum(np.log(step_gain))))
+    unsaturated_gain = np.exp(log_unsaturated_gain[:-1])
+    first_order = -k / step_gain
+    second_order = k / step_gain - k ** 2 / (2 * step_gain ** 2)
+    a = np.concatenate(([0.0], np.cumsum(first_order * unsaturated_gain)))
+    b = np.sum(first_order * unsaturated_gain * a[:-1] + second_order * unsaturated_gain ** 2)
+    return log_unsaturated_gain[-1], a[-1], b, float(np.sum(k * unsaturated_gain ** 2 / step_gain))
+
+
+def _low_intensity_output_powers(input_powers, small_signal_gains, saturation_intensities, config=None):
+    """Return second order perturbative output powers for weakly saturated beams and guaranteed bounds on
+    their absolute error, both for the model's rectangle rule."""
+    config = config or DEFAULT_CONFIG
+    input_powers = np.asarray(input_powers, dtype=float)
+    small_signal_gains = np.broadcast_to(np.asarray(small_signal_gains, dtype=float), input_powers.shape)
+    saturation_intensity = np.asarray(saturation_intensities, dtype=float)[..., np.newaxis]
+    weights = _radial_quadrature('rectangle', config=config.radial)[1]
+    x0 = 2 * input_powers[..., np.newaxis] / config.area * _radial_profile('rectangle', config=config.radial
+                                                                           ) / saturation_intensity
+    coefficients = np.array([_low_intensity_coefficients(small_signal_gain, config.axial)
+                             for small_signal_gain in small_signal_gains.reshape(-1).tolist()])
+    log_unsaturated_gain, a, b, second_moment = (
+        coefficients[:, i].reshape(small_signal_gains.shape)[..., np.newaxis] for i in range(4))
+    lower = a * x0
+    upper = (a * x0 + 2 * second_moment * x0 ** 2) * np.exp(a * x0)
+    eta = np.clip(a * x0 + b * x0 ** 2, lower, upper)
+    output_intensity = saturation_intensity * x0 * np.exp(log_unsaturated_gain + eta)
+    error_bound = np.sum(weights * output_intensity * np.expm1(np.maximum(eta - lower, upper - eta)), axis=-1)
+    return np.sum(output_intensity * weights, axis=-1), error_bound
+
+
+def _integrate_numpy(input_powers, small_signal_gains, saturation_intensities, quadrature=None, ring_tolerance=None,
+                     config=None):
+    if np is None:
+        raise RuntimeError('The numpy engine requires numpy to be installed')
+    config = config or DEFAULT_CONFIG
+    input_intensity = 2 * np.asarray(input_powers, dtype=float)[..., np.newaxis] / config.area
+    saturation_intensity = np.asarray(saturation_intensities, dtype=float)[..., np.newaxis]
+    expr2 = saturation_intensity * np.asarray(small_signal_gains, dtype=float)[..., np.newaxis] / 32000 * config.dz
+    weights = _radial_quadrature(quadrature, ring_tolerance, config.radial)[1]
+    output_intensity = input_intensity * _radial_profile(quadrature, ring_tolerance, config.radial)
+    output_intensity = np.broadcast_to(
+        output_intensity, np.broadcast_shapes(output_intensity.shape, expr2.shape)).copy()
+    gain = np.empty_like(output_intensity)
+    for expr1 in _axial_coefficients(config.axial).tolist():
+        np.add(saturation_intensity, output_intensity, out=gain)
+        np.divide(expr2, gain, out=gain)
+        gain += 1
+        gain -= expr1
+        output_intensity *= gain
+    return np.sum(output_intensity * weights, axis=-1)
+
+
+def _calculate_output_power_jit(input_power, small_signal_gain, saturation_intensity, quadrature=None,
+                                ring_tolerance=None, config=None):
+    if numba is None or np is None:
+        return _calculate_output_power(input_power, small_signal_gain, saturation_intensity, config)
+    config = config or DEFAULT_CONFIG
+    input_intensity = 2 * input_power / config.area
+    expr2 = saturation_intensity * small_signal_gain / 32000 * config.dz
+    weights = _radial_quadrature(quadrature, ring_tolerance, config.radial)[1]
+    return _jit_kernel()(input_intensity * _radial_profile(quadrature, ring_tolerance, config.radial), weights,
+                         expr2, float(saturation_intensity), _axial_coefficients(config.axial))
+
+
+@lru_cache(maxsize=None)
+def _jit_kernel():
+    # Compiled kernels are cached per module name, so running satin.py as a script and importing src.satin
+    # from the tests don't load each other's cache entries.
+    if not numba.config.CACHE_DIR:
+        numba.config.CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', __name__)
+    return numba.njit(cache=True)(_integrate_rings)
+
+
+def _integrate_rings(input_intensities, weights, expr2, saturation_intensity, expr1):
+    output_power = 0.0
+    for i in range(len(input_intensities)):  # pylint: disable=consider-using-enumerate
+        output_intensity = input_intensities[i]
+        for j in range(len(expr1)):  # pylint: disable=consider-using-enumerate
+            output_intensity = output_intensity * (1 + expr2 / (saturation_intensity + output_intensity) - expr1[j])
+        output_power += output_intensity * weights[i]
+    return output_power
+
+
+# Dormand-Prince 5(4) tableau: nodes, stage coefficients, 5th order weights and 5th - 4th order error weights.
+_DORMAND_PRINCE_C = (0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1)
+_DORMAND_PRINCE_A = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+    (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+)
+_DORMAND_PRINCE_B = (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0)
+_DORMAND_PRINCE_E = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+
+def _calculate_output_power_adaptive(input_power, small_signal_gain, saturation_intensity, tolerance=None,
+                                     quadrature=None, ring_tolerance=None, config=None):
+    return float(_integrate_adaptive(input_power, small_signal_gain, saturation_intensity, tolerance, quadrature,
+                                     ring_tolerance, config))
+
+
+def _integrate_adaptive(input_powers, small_signal_gains, saturation_intensities, tolerance=None, quadrature=None,
+                        ring_tolerance=None, config=None):
+    return _solve_adaptive(input_powers, small_signal_gains, saturation_intensities, tolerance, quadrature,
+                           ring_tolerance, config)[0]
+
+
+@lru_cache(maxsize=None)
+def _log_beam_expansion(config):
+    # log of the running product of (1 - EXPR1[j]), the intensity-independent part of each axial step
+    return _table('log_beam_expansion', config,
+                  lambda: np.concatenate(([0.0], np.cumsum(np.log1p(-_axial_coefficients(config))))))
+
+
+def _solve_adaptive(input_powers, small_signal_gains, saturation_intensities, tolerance=None, quadrature=None,
+                    ring_tolerance=None, config=None):
+    """Integrate the axial recurrence with an error-controlled Dormand-Prince step over the step index.
+
+    Each step of the recurrence multiplies the intensity by (1 - EXPR1[j]) * (1 + q) with the saturable
+    gain q = expr2 / ((saturation_intensity + intensity) * (1 - EXPR1[j])). The first factor does not
+    depend on the intensity and is taken from a table, leaving the slowly varying gain, which is
+    integrated adaptively through the first order modified equation of the fixed-step recurrence so that
+    the result reproduces it rather than the continuous limit. Returns the output powers and the number
+    of steps taken.
+    """
+    if np is None:
+        raise RuntimeError('The adaptive engine requires numpy to be installed')
+    tolerance = tolerance or ADAPTIVE_TOLERANCE
+    config = config or DEFAULT_CONFIG
+    incr, dz, z12 = config.incr, config.dz, config.z12
+    input_intensity = 2 * np.asarray(input_powers, dtype=float)[..., np.newaxis] / config.area
+    saturation_intensity = np.asarray(saturation_intensities, dtype=float)[..., np.newaxis]
+    expr2 = saturation_intensity * np.asarray(small_signal_gains, dtype=float)[..., np.newaxis] / 32000 * dz
+    weights = _radial_quadrature(quadrature, ring_tolerance, config.radial)[1]
+    log_beam_expansion = _log_beam_expansion(config.axial)
+    steps = np.arange(incr + 1, dtype=float)
+
+    def slope(j, scaled_intensity):
+        z = (j - incr // 2) / 25
+        expr1 = 2 * z * dz / (z12 + z ** 2)
+        expr1_slope = 2 * dz * (z12 - z ** 2) / (z12 + z ** 2) ** 2 / 25
+        intensity = np.exp(np.interp(j, steps, log_beam_expansion)) * scaled_intensity
+        q = expr2 / ((saturation_intensity + intensity) * (1 - expr1))
+        log_gain = np.log1p(q)
+        # Euler's leading error term: half the total derivative of log_gain along the solution
+        correction = q / (1 + q) * (expr1_slope / (1 - expr1) - intensity / (saturation_intensity + intensity) * (
+            np.log1p(-expr1) + log_gain))
+        return scaled_intensity * (log_gain - correction / 2)
+
+    scaled_intensity = input_intensity * _radial_profile(quadrature, ring_tolerance, config.radial)
+    scaled_intensity = np.broadcast_to(
+        scaled_intensity, np.broadcast_shapes(scaled_intensity.shape, expr2.shape)).copy()
+    k1 = slope(0.0, scaled_intensity)
+    j, h, step_count = 0.0, incr / 100, 0
+    while j < incr:
+        h = min(h, incr - j)
+        slopes = [k1]
+        for c, a in zip(_DORMAND_PRINCE_C[1:], _DORMAND_PRINCE_A[1:]):
+            stage = scaled_intensity + h * sum(coefficient * k for coefficient, k in zip(a, slopes))
+            slopes.append(slope(j + c * h, stage))
+        next_scaled_intensity = scaled_intensity + h * sum(b * k for b, k in zip(_DORMAND_PRINCE_B, slopes))
+        error = h * sum(e * k for e, k in zip(_DORMAND_PRINCE_E, slopes))
+        scale = tolerance * np.maximum(np.abs(scaled_intensity), np.abs(next_scaled_intensity)) + np.finfo(float).tiny
+        error_norm = np.max(np.abs(error) / scale)
+        step_count += 1
+        if error_norm <= 1:
+            j, scaled_intensity, k1 = j + h, next_scaled_intensity, slopes[-1]
+        h *= min(5.0, max(0.2, 0.9 * error_norm ** -0.2)) if error_norm > 0 else 5.0
+
+    output_intensity = np.exp(log_beam_expansion[-1]) * scaled_intensity
+    return np.sum(output_intensity * weights, axis=-1), step_count
+
+
+def _integrate_transfer(input_powers, small_signal_gains, saturation_intensities, tolerance=None, quadrature=None,
+                        ring_tolerance=None, config=None):
+    return _solve_transfer(input_powers, small_signal_gains, saturation_intensities, tolerance, quadrature,
+                           ring_tolerance, config)[0]
+
+
+def _solve_transfer(input_powers, small_signal_gains, saturation_intensities, tolerance=None, quadrature=None,
+                    ring_tolerance=None, config=None, normalise=True):
+    """Calculate output powers from a tabulated transfer function of the axial recurrence.
+
+    For a given small-signal gain and saturation intensity every ring goes through the same recurrence from
+    a different starting intensity. Its log gain, log(output / input intensity), is tabulated against the
+    log of the starting intensity over the range the rings need, refining the table until cubic Hermite
+    interpolation between its nodes is within the relative tolerance, and every ring of every input power
+    is then interpolated from the table. The tables are refined together.
+
+    Divided by the saturation intensity, the recurrence becomes x * (1 + k / (1 + x) - EXPR1[j]) with
+    k = small_signal_gain / 32000 * DZ, which depends on the gain alone. With normalise the tables are
+    therefore kept in I / Isat, one per gain, and shared by every saturation intensity; without it there
+    is a table per (gain, saturation intensity) pair. Returns the output powers and the number of starting
+    intensities integrated.
+    """
+    if np is None:
+        raise RuntimeError('The transfer engine requires numpy to be installed')
+    tolerance = tolerance or TRANSFER_TOLERANCE
+    config = config or DEFAULT_CONFIG
+    input_powers, small_signal_gains, saturation_intensities = np.broadcast_arrays(
+        np.asarray(input_powers, dtype=float), np.asarray(small_signal_gains, dtype=float),
+        np.asarray(saturation_intensities, dtype=float))
+    weights = _radial_quadrature(quadrature, ring_tolerance, config.radial)[1]
+    scale = saturation_intensities.reshape(-1, 1) if normalise else 1.0
+    input_intensities = 2 * input_powers.reshape(-1, 1) / config.area * _radial_profile(
+        quadrature, ring_tolerance, config.radial) / scale
+    if normalise:
+        pairs, pair_of_point = np.unique(small_signal_gains.reshape(-1), return_inverse=True)
+        pairs = np.column_stack((pairs, np.ones(len(pairs))))
+    else:
+        pairs, pair_of_point = np.unique(
+            np.column_stack((small_signal_gains.reshape(-1), saturation_intensities.reshape(-1))), axis=0,
+            return_inverse=True)
+    pair_of_point = pair_of_point.reshape(-1)
+    lower = np.full(len(pairs), np.inf)
+    upper = np.zeros(len(pairs))
+    np.minimum.at(lower, pair_of_point, input_intensities.min(axis=1))
+    np.maximum.at(upper, pair_of_point, input_intensities.max(axis=1))
+    tables, integrations = _transfer_tables(pairs[:, 1] * pairs[:, 0] / 32000 * config.dz, pairs[:, 1],
+                                            np.log(lower), np.log(np.maximum(upper, 2 * lower)), tolerance, config)
+    output_powers = np.empty(len(input_intensities))
+    for pair, (nodes, log_gain, log_gain_slope) in enumerate(tables):
+        points = pair_of_point == pair
+        log_intensities = np.log(input_intensities[points])
+        output_powers[points] = np.sum(
+            np.exp(log_intensities + _hermite(nodes, log_gain, log_gain_slope, log_intensities)) * weights, axis=-1)
+    if normalise:
+        output_powers *= saturation_intensities.reshape(-1)
+    return output_powers.reshape(input_powers.shape), integrations
+
+
+def _transfer_function(input_power, small_signal_gain, lower, upper, config):
+    # the output power as a function of the saturation intensity between lower and upper, interpolated from
+    # the transfer table in I / Isat of the small-signal gain over the range of every ring
+    log_intensities = np.log(2 * input_power / config.area * _radial_profile(config=config.radial))
+    weights = _radial_quadrature(config=config.radial)[1]
+    # the range is widened to multiples of 4 table steps so that inversions at nearby input powers and
+    # saturation intensities share a table
+    step = 4 * TRANSFER_STEP
+    nodes, log_gain, log_gain_slope = _transfer_table(
+        small_signal_gain, step * math.floor((log_intensities.min() - math.log(upper)) / step),
+        step * math.ceil((log_intensities.max() - math.log(lower)) / step), config)
+
+    def output_power(saturation_intensity):
+        points = log_intensities - math.log(saturation_intensity)
+        return saturation_intensity * float(np.sum(
+            np.exp(points + _hermite(nodes, log_gain, log_gain_slope, points)) * weights))
+    return output_power
+
+
+@lru_cache(maxsize=256)
+def _transfer_table(small_signal_gain, lower, upper, config):
+    (table,), _ = _transfer_tables(np.array([small_signal_gain / 32000 * config.dz]), np.ones(1), np.array([lower]),
+                                   np.array([upper]), TRANSFER_TOLERANCE, config)
+    return table
+
+
+def _transfer_tables(expr2, saturation_intensities, lower, upper, tolerance, config):
+    # Start each table on nodes TRANSFER_STEP apart in log intensity, then halve every interval whose midpoint
+    # isn't interpolated to within tolerance until none are left, integrating each round's midpoints in one go.
+    # Returns (nodes, log gain, slope of log gain) for each pair, and the number of starting intensities integrated.
+    nodes = [np.linspace(low, high, max(2, math.ceil((high - low) / TRANSFER_STEP) + 1))
+             for low, high in zip(lower.tolist(), upper.tolist())]
+    log_gains = _log_transfer(nodes, expr2, saturation_intensities, config)
+    tables = [(pair_nodes,) + log_gain for pair_nodes, log_gain in zip(nodes, log_gains)]
+    refining = [np.ones(len(pair_nodes) - 1, dtype=bool) for pair_nodes in nodes]
+    integrations = sum(len(pair_nodes) for pair_nodes in nodes)
+    while any(pair_refining.any() for pair_refining in refining):
+        midpoints = [((pair_nodes[:-1] + pair_nodes[1:]) / 2)[pair_refining]
+                     for (pair_nodes, _, _), pair_refining in zip(tables, refining)]
+        integrations += sum(len(pair_midpoints) for pair_midpoints in midpoints)
+        midpoint_log_gains = _log_transfer(midpoints, expr2, saturation_intensities, config)
+        for pair, ((pair_nodes, log_gain, slope), pair_midpoints, (midpoint_log_gain, midpoint_slope)) in enumerate(
+                zip(tables, midpoints, midpoint_log_gains)):
+            if len(pair_midpoints) == 0:
+                continue
+            inaccurate = np.abs(_hermite(pair_nodes, log_gain, slope, pair_midpoints) - midpoint_log_gain) > tolerance
+            # an interval that was split carries on refining in both halves if its midpoint was inaccurate
+            left_refining = np.zeros(len(pair_nodes), dtype=bool)
+            left_refining[:-1][refining[pair]] = inaccurate
+            order = np.argsort(np.concatenate((pair_nodes, pair_midpoints)), kind='stable')
+            tables[pair] = tuple(np.concatenate(values)[order] for values in (
+                (pair_nodes, pair_midpoints), (log_gain, midpoint_log_gain), (slope, midpoint_slope)))
+            refining[pair] = np.concatenate((left_refining, inaccurate))[order][:-1]
+    return tables, integrations
+
+
+def _log_transfer(log_intensities, expr2, saturation_intensities, config):
+    # the log gain of the axial recurrence and its derivative, both against the log of the starting intensity,
+    # for lists of log starting intensities, one list per (expr2, saturation intensity) pair
+    sizes = [len(pair_log_intensities) for pair_log_intensities in log_intensities]
+    input_intensity = np.exp(np.concatenate(log_intensities))
+    expr2 = np.repeat(expr2, sizes)
+    saturation_intensity = np.repeat(saturation_intensities, sizes)
+    output_intensity = input_intensity.copy()
+    derivative = np.ones_like(output_intensity)
+    gain = np.empty_like(output_intensity)
+    step_gain = np.empty_like(output_intensity)
+    for expr1 in _axial_coefficients(config.axial).tolist():
+        np.add(saturation_intensity, output_intensity, out=gain)
+        np.divide(expr2, gain, out=step_gain)
+        # d(step output) / d(step input) = step gain - intensity * expr2 / (saturation_intensity + intensity) ** 2
+        np.multiply(output_intensity, step_gain, out=gain)
+        np.divide(gain, saturation_intensity + output_intensity, out=gain)
+        step_gain += 1
+        step_gain -= expr1
+        np.subtract(step_gain, gain, out=gain)
+        derivative *= gain
+        output_intensity *= step_gain
+    log_gain = np.log(output_intensity / input_intensity)
+    slope = input_intensity * derivative / output_intensity - 1
+    split = np.cumsum(sizes)[:-1]
+    return list(zip(np.split(log_gain, split), np.split(slope, split)))
+
+
+def _hermite(nodes, values, slopes, points):
+    # cubic Hermite interpolation of values with the given slopes at the sorted nodes
+    i = np.clip(np.searchsorted(nodes, points) - 1, 0, len(nodes) - 2)
+    h = nodes[i + 1] - nodes[i]
+    t = (points - nodes[i]) / h
+    return ((2 * t - 3) * t ** 2 + 1) * values[i] + ((t - 2) * t + 1) * t * h * slopes[i] + \
+        (3 - 2 * t) * t ** 2 * values[i + 1] + (t - 1) * t ** 2 * h * slopes[i + 1]
+
+
+_ENGINES = {}
+
+
+def register_engine(name, calculate_output_power, calculate_output_powers=None):
+    """Register a calculation engine under name.
+
+    calculate_output_power(input_power, small_signal_gain, saturation_intensity) calculates a single point.
+    The optional calculate_output_powers takes arrays of input powers, small-signal gains and saturation
+    intensities and calculates every point in one call; without it points are calculated one at a time.
+    Both are also passed a config keyword argument when the caller gives a SatinConfig.
+    """
+    _ENGINES[name] = Engine(calculate_output_power, calculate_output_powers)
+    _memo.clear()
+
+
+def engines():
+    """Return the names of the registered calculation engines."""
+    return sorted(_ENGINES)
+
+
+def _get_engine(name):
+    try:
+        return _ENGINES[name]
+    except KeyError:
+        raise ValueError(f'Unknown engine {name!r}, expected one of {", ".join(engines())}') from None
+
+
+def _engine_key(name):
+    # the engine name qualified by any non-default settings it was registered with, e.g. its quadrature
+    settings = getattr(_get_engine(name).calculate_output_power, 'keywords', {})
+    return ','.join([name] + [f'{key}={value}' for key, value in sorted(settings.items()) if value is not None])
+
+
+_engine_settings = (None, None, None)
+
+
+def _register_default_engines(tolerance=None, quadrature=None, ring_tolerance=None):
+    # the settings are passed on to the workers of process pools started after this
+    global _engine_settings
+    _engine_settings = (tolerance, quadrature, ring_tolerance)
+    radial = {'quadrature': quadrature, 'ring_tolerance': ring_tolerance}
+    register_engine('pure', _calculate_output_power)
+    register_engine('numpy', partial(_calculate_output_power_numpy, **radial), partial(_integrate_numpy, **radial))
+    register_engine('jit', partial(_calculate_output_power_jit, **radial))
+    register_engine('adaptive', partial(_calculate_output_power_adaptive, tolerance=tolerance, **radial),
+                    partial(_integrate_adaptive, tolerance=tolerance, **radial))
+    # a table only pays for itself over many points, so single points are integrated ring by ring
+    register_engine('transfer', partial(_calculate_output_power_numpy, **radial),
+                    partial(_integrate_transfer, **radial))
+
+
+_register_default_engines()
+
+
 if __name__ == '__main__':
     Satin.main()
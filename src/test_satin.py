@@ -1,15 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from math import log
+from multiprocessing import shared_memory
 import os
 
 import pytest
 
-from src.satin import gaussian_calculation
+from src.satin import (DEFAULT_CONFIG, INCR, QUADRATURE_NODES, Laser, ResultCache, SatinConfig,
+                       _calculate_output_power_numpy, _integrate_adaptive, _radial_quadrature, _solve_adaptive,
+                       _solve_transfer, accuracy_report, benchmark_normalisation, benchmark_scaling, calculate_point,
+                       engines, fit_datasets, fit_parameters, gaussian_calculation, get_executor, process_pool,
+                       register_engine, results_table, solve_grid, solve_grid_blocks, solve_saturation_intensity,
+                       sweep, write_results)
+from src import satin
 
 
 def _read_csv(file_path):
     with open(file_path, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+        reader = csv.reader(csvfile)
         return list(reader)
 
 
@@ -19,6 +27,7 @@ def _round_up(value):
 
 script_directory = os.path.dirname(os.path.abspath(__file__))
 csv_file_path = os.path.join(script_directory, 'satin.csv')
+all_csv_file_path = os.path.join(script_directory, 'satin-all.csv')
 
 
 @pytest.mark.parametrize(
@@ -26,11 +35,398 @@ csv_file_path = os.path.join(script_directory, 'satin.csv')
     'log_output_power_divided_by_input_power, output_power_minus_input_power',
     _read_csv(csv_file_path)
 )
+@pytest.mark.parametrize('engine', engines())
 def test_gaussian_calculation(input_power, small_signal_gain, saturation_intensity, output_power,
-                              log_output_power_divided_by_input_power, output_power_minus_input_power):
-    for gaussian in gaussian_calculation(int(input_power), float(small_signal_gain)):
-        if gaussian.saturation_intensity == int(saturation_intensity):
-            assert _round_up(gaussian.output_power) == float(output_power)
-            assert _round_up(log(gaussian.output_power / gaussian.input_power)) == float(
-                log_output_power_divided_by_input_power)
-            assert _round_up(gaussian.output_power - gaussian.input_power) == float(output_power_minus_input_power)
+                              log_output_power_divided_by_input_power, output_power_minus_input_power, engine):
+    gaussian = calculate_point(int(input_power), float(small_signal_gain), int(saturation_intensity), engine=engine)
+    assert gaussian.saturation_intensity == int(saturation_intensity)
+    assert _round_up(gaussian.output_power) == float(output_power)
+    assert _round_up(log(gaussian.output_power / gaussian.input_power)) == float(
+        log_output_power_divided_by_input_power)
+    assert _round_up(gaussian.output_power - gaussian.input_power) == float(output_power_minus_input_power)
+
+
+@pytest.mark.parametrize(
+    'input_power, small_signal_gain, saturation_intensity, output_power, '
+    'log_output_power_divided_by_input_power, output_power_minus_input_power',
+    _read_csv(all_csv_file_path)
+)
+def test_calculate_output_power_numpy(input_power, small_signal_gain, saturation_intensity, output_power,
+                                      log_output_power_divided_by_input_power, output_power_minus_input_power):
+    pytest.importorskip('numpy')
+    calculated_output_power = _calculate_output_power_numpy(int(input_power), float(small_signal_gain),
+                                                            int(saturation_intensity))
+    assert _round_up(calculated_output_power) == float(output_power)
+    assert _round_up(log(calculated_output_power / int(input_power))) == float(log_output_power_divided_by_input_power)
+    assert _round_up(calculated_output_power - int(input_power)) == float(output_power_minus_input_power)
+
+
+def _group_by_input_power_and_small_signal_gain(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault((int(row[0]), float(row[1])), {})[int(row[2])] = float(row[3])
+    return list(groups.items())
+
+
+@pytest.mark.parametrize('input_power_and_small_signal_gain, output_powers',
+                         _group_by_input_power_and_small_signal_gain(_read_csv(all_csv_file_path)))
+def test_gaussian_calculation_batched(input_power_and_small_signal_gain, output_powers):
+    pytest.importorskip('numpy')
+    input_power, small_signal_gain = input_power_and_small_signal_gain
+    gaussians = gaussian_calculation(input_power, small_signal_gain, engine='numpy', batched=True)
+    assert {gaussian.saturation_intensity: _round_up(gaussian.output_power) for gaussian in gaussians} == output_powers
+
+
+def test_solve_grid():
+    pytest.importorskip('numpy')
+    rows = _read_csv(all_csv_file_path)
+    small_signal_gains = list(dict.fromkeys(float(row[1]) for row in rows))
+    input_powers = list(dict.fromkeys(int(row[0]) for row in rows))
+    lasers = [Laser(None, small_signal_gain, None, None) for small_signal_gain in small_signal_gains]
+    grid = solve_grid(lasers, input_powers)
+    assert grid.shape == (len(small_signal_gains), len(input_powers), 16)
+    output_powers = {
+        (int(result['input_power']), float(result['small_signal_gain']), int(result['saturation_intensity'])):
+            _round_up(float(result['output_power']))
+        for result in grid.reshape(-1)
+    }
+    assert output_powers == {(int(row[0]), float(row[1]), int(row[2])): float(row[3]) for row in rows}
+
+
+def test_process_pool_is_shared_until_closed():
+    with process_pool(max_workers=2) as executor:
+        assert get_executor() is executor
+        assert executor.submit(abs, -1).result() == 1
+    assert get_executor() is not executor
+
+
+def _attached_tables():
+    return sorted(satin._attached_tables)
+
+
+def test_process_pool_shares_tables():
+    pytest.importorskip('numpy')
+    with process_pool(max_workers=2) as executor:
+        assert executor.submit(_attached_tables).result() == [
+            f'{name}-{satin.model_hash()}' for name in ('expr1', 'log_beam_expansion')]
+        names = [descriptor[1] for descriptor in satin._shared_executor._tables.descriptors]
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_solve_grid_parallel():
+    pytest.importorskip('numpy')
+    rows = [row for row in _read_csv(csv_file_path) if float(row[1]) == 24.2]
+    with process_pool(max_workers=2):
+        grid = solve_grid([Laser(None, 24.2, None, None)], [1, 10, 50, 100, 150], [10000, 25000], parallel=True)
+    assert [_round_up(output_power) for output_power in grid['output_power'].reshape(-1).tolist()] == [
+        float(row[3]) for row in rows]
+
+
+def test_process_pool_workers_use_engine_settings():
+    pytest.importorskip('numpy')
+    lasers = [Laser(None, 24.2, None, None)]
+    satin._register_default_engines(ring_tolerance=1e-2)
+    try:
+        grid = solve_grid(lasers, [100, 150], [10000, 25000])
+        with process_pool(max_workers=2, context='spawn'):
+            parallel_grid = solve_grid(lasers, [100, 150], [10000, 25000], parallel=True)
+    finally:
+        satin._register_default_engines()
+    assert parallel_grid.tolist() == grid.tolist()
+    assert grid.tolist() != solve_grid(lasers, [100, 150], [10000, 25000]).tolist()
+
+
+def test_benchmark_scaling():
+    pytest.importorskip('numpy')
+    timings = benchmark_scaling([Laser(None, 24.2, None, None)], [1], [10000], worker_counts=[1, 2])
+    assert [workers for workers, _ in timings] == [1, 2]
+    assert all(seconds > 0 for _, seconds in timings)
+
+
+
+def _echo_input_power(input_power, *_):
+    return input_power
+
+
+def test_register_engine():
+    register_engine('echo', _echo_input_power)
+    assert 'echo' in engines()
+    gaussians = gaussian_calculation(7, 24.2, engine='echo', batched=True)
+    assert [gaussian.output_power for gaussian in gaussians] == [7] * 16
+    with pytest.raises(ValueError):
+        gaussian_calculation(7, 24.2, engine='unknown', batched=True)
+
+
+def test_result_cache(tmp_path):
+    pytest.importorskip('numpy')
+    lasers = [Laser(None, 24.2, None, None)]
+    with ResultCache(tmp_path / 'satin.db', max_entries=3) as cache:
+        grid = solve_grid(lasers, [1, 10], [10000, 25000], cache=cache)
+        assert (cache.hits, cache.misses, len(cache)) == (0, 4, 3)
+        cached_grid = solve_grid(lasers, [1, 10], [10000, 25000], cache=cache)
+        assert (cache.hits, cache.misses, len(cache)) == (3, 5, 3)
+    assert cached_grid.tolist() == grid.tolist()
+    assert [_round_up(output_power) for output_power in grid['output_power'].reshape(-1).tolist()] == [
+        1.266, 1.268, 12.463, 12.586]
+
+
+def test_gaussian_calculation_memoizes_and_coalesces():
+    register_engine('echo', _echo_input_power)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: gaussian_calculation(3, 24.2, engine='echo'), range(4)))
+    assert all(gaussians == results[0] for gaussians in results)
+    assert (satin._memo.hits, satin._memo.misses) == (48, 16)
+
+
+def test_gaussian_calculation_computes_only_requested_saturation_intensities():
+    register_engine('echo', _echo_input_power)
+    for batched in (False, True):
+        gaussians = gaussian_calculation(5, 24.2, engine='echo', batched=batched,
+                                         saturation_intensities=(s for s in [12000, 17000]))
+        assert gaussians == [(5, 5, 12000), (5, 5, 17000)]
+    assert calculate_point(6, 24.2, 21000, engine='echo') == (6, 6, 21000)
+    assert (satin._memo.hits, satin._memo.misses) == (0, 3)
+
+
+def test_solve_grid_calculates_duplicate_points_once():
+    pytest.importorskip('numpy')
+    calculated = []
+    register_engine('counting', lambda *unit: calculated.append(unit) or unit[0])
+    lasers = [Laser(None, 24.2, None, None), Laser(None, 24.2, None, None)]
+    grid = solve_grid(lasers, [1, 1, 2], [10000], engine='counting')
+    assert grid['output_power'].reshape(-1).tolist() == [1, 1, 2, 1, 1, 2]
+    assert len(calculated) == 2
+
+
+def test_adaptive_engine_matches_with_fewer_steps():
+    pytest.importorskip('numpy')
+    rows = _read_csv(all_csv_file_path)
+    output_powers, steps = _solve_adaptive([int(row[0]) for row in rows], [float(row[1]) for row in rows],
+                                           [int(row[2]) for row in rows])
+    assert steps < INCR / 100
+    assert max(abs(calculated - float(row[3])) for calculated, row in zip(output_powers.tolist(), rows)) < 1e-3
+
+
+def test_transfer_engine_matches_with_fewer_integrations():
+    pytest.importorskip('numpy')
+    rows = _read_csv(all_csv_file_path)
+    output_powers, integrations = _solve_transfer([int(row[0]) for row in rows], [float(row[1]) for row in rows],
+                                                  [int(row[2]) for row in rows])
+    assert integrations < len(rows) * QUADRATURE_NODES['rectangle'] / 5
+    assert max(abs(calculated - float(row[3])) for calculated, row in zip(output_powers.tolist(), rows)) < 1e-3
+
+
+def test_transfer_engine_normalises_saturation_intensity():
+    pytest.importorskip('numpy')
+    rows = _read_csv(all_csv_file_path)
+    units = [int(row[0]) for row in rows], [float(row[1]) for row in rows], [int(row[2]) for row in rows]
+    output_powers, integrations = _solve_transfer(*units)
+    pair_output_powers, pair_integrations = _solve_transfer(*units, normalise=False)
+    assert integrations < pair_integrations / 10
+    assert output_powers.tolist() == pytest.approx(pair_output_powers.tolist(), rel=1e-8)
+    (_, pair_integrations), (_, integrations) = benchmark_normalisation([Laser(None, 24.2, None, None)], [1, 150])
+    assert integrations < pair_integrations
+
+
+@pytest.mark.parametrize('quadrature', sorted(QUADRATURE_NODES))
+def test_radial_quadrature(quadrature):
+    pytest.importorskip('numpy')
+    rows = _read_csv(all_csv_file_path)
+    output_powers = _integrate_adaptive([int(row[0]) for row in rows], [float(row[1]) for row in rows],
+                                        [int(row[2]) for row in rows], quadrature=quadrature)
+    assert max(abs(calculated - float(row[3])) for calculated, row in zip(output_powers.tolist(), rows)) < 1e-3
+    assert len(_radial_quadrature(quadrature)[0]) <= QUADRATURE_NODES[quadrature] + 2
+
+
+def test_accuracy_report():
+    pytest.importorskip('numpy')
+    rows, max_error, mismatches = accuracy_report(csv_file_path, engine='adaptive')
+    assert (rows, mismatches) == (80, 0)
+    assert max_error <= 0.0005 + 1e-6
+
+
+@pytest.mark.parametrize('ring_tolerance', [1e-6, 1e-4])
+def test_ring_tolerance(ring_tolerance):
+    pytest.importorskip('numpy')
+    rows = _read_csv(all_csv_file_path)
+    units = [int(row[0]) for row in rows], [float(row[1]) for row in rows], [int(row[2]) for row in rows]
+    output_powers = _integrate_adaptive(*units)
+    truncated_output_powers = _integrate_adaptive(*units, ring_tolerance=ring_tolerance)
+    assert len(_radial_quadrature(ring_tolerance=ring_tolerance)[0]) < len(_radial_quadrature()[0])
+    assert (abs(truncated_output_powers - output_powers) <= 2 * ring_tolerance * output_powers).all()
+
+
+def test_table_cache(tmp_path, monkeypatch):
+    pytest.importorskip('numpy')
+    expected = satin.EXPR1.tolist()
+    monkeypatch.setattr(satin, 'TABLE_CACHE', str(tmp_path))
+    try:
+        for _ in range(2):
+            satin._axial_coefficients.cache_clear()
+            assert satin.EXPR1.tolist() == expected
+            assert satin.EXPR1.filename and not satin.EXPR1.flags.writeable
+        assert len(list(tmp_path.iterdir())) == 1
+    finally:
+        satin._axial_coefficients.cache_clear()
+
+
+def test_satin_config(tmp_path):
+    pytest.importorskip('numpy')
+    path = tmp_path / 'config.json'
+    path.write_text('{"rad": 0.2, "dr": 0.01, "incr": 801, "saturation_intensities": [10000, 20000]}')
+    config = SatinConfig.load(path)
+    assert config == DEFAULT_CONFIG._replace(rad=0.2, dr=0.01, incr=801, saturation_intensities=(10000, 20000))
+    grid = solve_grid([Laser(None, 24.2, None, None)], [10, 100], config=config)
+    assert grid.shape == (1, 2, 2)
+    for input_power, results in zip([10, 100], grid[0]):
+        assert [output_power for _, output_power, _ in gaussian_calculation(input_power, 24.2, config=config)] == \
+            pytest.approx(results['output_power'].tolist(), rel=1e-12)
+    default = solve_grid([Laser(None, 24.2, None, None)], [10, 100], [10000, 20000])
+    assert (abs(grid['output_power'] / default['output_power'] - 1) > 1e-3).all()
+    path.write_text('{"radius": 0.2}')
+    with pytest.raises(ValueError):
+        SatinConfig.load(path)
+
+
+def test_sweep():
+    pytest.importorskip('numpy')
+    lasers = [Laser(None, 24.2, None, None), Laser(None, 29.9, None, None)]
+    with process_pool(max_workers=2):
+        table = sweep(lasers, [10, 100], rad=[0.18, 0.2], w1=[0.3, 0.35], engine='adaptive')
+    assert len(table) == 2 * 2 * len(lasers) * 2 * len(DEFAULT_CONFIG.saturation_intensities)
+    for rad in [0.18, 0.2]:
+        for w1 in [0.3, 0.35]:
+            config = DEFAULT_CONFIG._replace(rad=rad, w1=w1)
+            rows = table[(table['rad'] == rad) & (table['w1'] == w1)]
+            grid = solve_grid(lasers, [10, 100], engine='adaptive', config=config)
+            assert rows['output_power'].tolist() == pytest.approx(grid['output_power'].reshape(-1).tolist(), rel=1e-7)
+    assert DEFAULT_CONFIG._replace(w1=0.35).radial == DEFAULT_CONFIG.radial
+
+
+def test_write_reports(tmp_path):
+    pytest.importorskip('numpy')
+    lasers = [Laser(str(tmp_path / f'{name}.out'), gain, 8, 'MD') for name, gain in (('a', 24.2), ('b', 29.9))]
+    blocks = list(solve_grid_blocks(lasers, [1, 10, 50], block_size=2, engine='adaptive'))
+    assert [grid.shape for grid in blocks] == [(2, 2, 16), (2, 1, 16)]
+    summary = satin._write_reports(lasers, iter(blocks))
+    grid = solve_grid(lasers, [1, 10, 50], engine='adaptive')
+    assert summary['input_power'].tolist() == grid['input_power'].tolist()
+    for laser, results in zip(lasers, grid):
+        with open(laser.output_file, encoding='utf-8') as file:
+            rows = [line.split() for line in file.read().splitlines()[10:-2]]
+        assert [(int(row[0]), int(row[2])) for row in rows] == \
+            results[['input_power', 'saturation_intensity']].reshape(-1).tolist()
+        assert [float(row[1]) for row in rows] == pytest.approx(results['output_power'].reshape(-1).tolist(), rel=1e-7)
+    satin._write_reports(lasers, iter(blocks), str(tmp_path / 'all.out'))
+    with open(tmp_path / 'all.out', encoding='utf-8') as file:
+        consolidated = file.read().splitlines()
+    for laser in lasers:
+        with open(laser.output_file, encoding='utf-8') as file:
+            assert [line[len(laser.output_file) + 2:] for line in consolidated
+                    if line.startswith(laser.output_file)][1:] == \
+                file.read().splitlines()[10:-2]
+
+
+def test_write_results(tmp_path):
+    np = pytest.importorskip('numpy')
+    gains = list(dict.fromkeys(float(row[1]) for row in _read_csv(all_csv_file_path)))
+    lasers = [Laser(f'{i}.out', gain, 8, 'MD') for i, gain in enumerate(gains)]
+    table = results_table(lasers, solve_grid(lasers, [1, 10, 50, 100, 150], engine='adaptive'))
+    write_results(str(tmp_path / 'satin-all.csv'), table)
+    with open(tmp_path / 'satin-all.csv', encoding='utf-8') as actual, \
+            open(all_csv_file_path, encoding='utf-8') as expected:
+        assert actual.read() == expected.read()
+    write_results(str(tmp_path / 'satin.npy'), table)
+    assert np.load(tmp_path / 'satin.npy', mmap_mode='r').tolist() == table.tolist()
+    with pytest.raises(ValueError):
+        write_results(str(tmp_path / 'satin.txt'), table)
+
+
+def test_solve_grid_low_intensity_fast_path():
+    pytest.importorskip('numpy')
+    rows = [row for row in _read_csv(all_csv_file_path) if float(row[1]) == 24.2]
+    grid = solve_grid([Laser(None, 24.2, None, None)], [1, 10, 50, 100, 150], low_intensity_tolerance=1e-4)
+    assert grid['fast_path'][0, 0].all()
+    assert not grid['fast_path'][0, 1:].any()
+    assert [_round_up(output_power) for output_power in grid['output_power'].reshape(-1).tolist()] == [
+        float(row[3]) for row in rows]
+
+
+def test_result_cache_skips_low_intensity_estimates(tmp_path):
+    pytest.importorskip('numpy')
+    lasers = [Laser(None, 24.2, None, None)]
+    with ResultCache(tmp_path / 'satin.db') as cache:
+        estimated = solve_grid(lasers, [1, 100], [10000], cache=cache, low_intensity_tolerance=1e-4)
+        assert estimated['fast_path'].reshape(-1).tolist() == [True, False]
+        assert len(cache) == 1
+        cached = solve_grid(lasers, [1, 100], [10000], cache=cache)
+    assert cached.tolist() == solve_grid(lasers, [1, 100], [10000]).tolist()
+    assert cached['output_power'][0, 0, 0] != estimated['output_power'][0, 0, 0]
+
+
+@pytest.mark.parametrize('engine', [None, 'numpy'])
+@pytest.mark.parametrize('input_power, small_signal_gain, saturation_intensity', [
+    (10, 24.2, 12000), (150, 24.2, 30000), (100, 16.8, 4000)])
+def test_solve_saturation_intensity(input_power, small_signal_gain, saturation_intensity, engine):
+    pytest.importorskip('numpy')
+    output_power = _calculate_output_power_numpy(input_power, small_signal_gain, saturation_intensity)
+    inversion = solve_saturation_intensity(input_power, output_power, small_signal_gain, engine=engine)
+    assert inversion.saturation_intensity == pytest.approx(saturation_intensity, rel=1e-5)
+    assert inversion.output_power == pytest.approx(output_power, rel=1e-6)
+    assert inversion.evaluations < len(DEFAULT_CONFIG.saturation_intensities)
+
+
+def test_solve_saturation_intensity_caches_evaluations(tmp_path):
+    pytest.importorskip('numpy')
+    output_power = _calculate_output_power_numpy(100, 24.2, 20000)
+    with ResultCache(tmp_path / 'satin.db') as cache:
+        inversion = solve_saturation_intensity(100, output_power, 24.2, engine='numpy', cache=cache)
+        assert cache.misses == inversion.evaluations
+        assert solve_saturation_intensity(100, output_power, 24.2, engine='numpy', cache=cache) == inversion
+        assert cache.hits == inversion.evaluations
+    with pytest.raises(ValueError):
+        solve_saturation_intensity(100, 1000, 24.2)
+
+
+def _datasets(small_signal_gains_and_saturation_intensities):
+    datasets = {key: ([], []) for key in small_signal_gains_and_saturation_intensities}
+    for row in _read_csv(all_csv_file_path):
+        if (float(row[1]), int(row[2])) in datasets:
+            input_powers, output_powers = datasets[float(row[1]), int(row[2])]
+            input_powers.append(int(row[0]))
+            output_powers.append(float(row[3]))
+    return list(datasets.values())
+
+
+def test_fit_parameters():
+    pytest.importorskip('numpy')
+    input_powers = [1, 10, 50, 100, 150]
+    output_powers = [_calculate_output_power_numpy(input_power, 21.2, 14000) for input_power in input_powers]
+    fit = fit_parameters(input_powers, output_powers)
+    assert (fit.small_signal_gain, fit.saturation_intensity) == pytest.approx((21.2, 14000), rel=1e-9)
+    assert abs(fit.residuals).max() < 1e-9
+    assert fit.evaluations % (3 * len(input_powers)) == 0
+
+
+def test_fit_parameters_caches_evaluations(tmp_path):
+    pytest.importorskip('numpy')
+    (input_powers, output_powers), = _datasets([(24.2, 10000)])
+    with ResultCache(tmp_path / 'satin.db') as cache:
+        fit = fit_parameters(input_powers, output_powers, cache=cache)
+        assert cache.misses == fit.evaluations
+        cached_fit = fit_parameters(input_powers, output_powers, cache=cache)
+    assert cached_fit.evaluations == 0
+    assert cached_fit.residuals.tolist() == fit.residuals.tolist()
+
+
+def test_fit_datasets():
+    pytest.importorskip('numpy')
+    keys = [(24.2, 10000), (17.6, 25000), (29.9, 18000)]
+    with process_pool(max_workers=2):
+        fits = fit_datasets(_datasets(keys))
+    for (small_signal_gain, saturation_intensity), fit in zip(keys, fits):
+        assert fit.small_signal_gain == pytest.approx(small_signal_gain, rel=1e-3)
+        assert fit.saturation_intensity == pytest.approx(saturation_intensity, rel=1e-3)
+        assert abs(fit.residuals).max() < 1e-3